@@ -16,6 +16,7 @@ from archmm.iohmm import *
 from utils import *
 from cognitive import *
 from spectral import *
+from dataset import *
 
 FFT_METHOD = 0
 CQT_METHOD = 1
@@ -98,31 +99,22 @@ def extractFeatures(filename):
     
     return feature_matrix
 
-def saveFeatures(dataset):
-    inputs, targets = dict(), dict()
-    for i in dataset.keys():
-        entry = dataset[i]
-        target_key, filename = entry[2], entry[3]
-        try:
-            print("Processing file %i" % i)
-            feature_matrix = extractFeatures(filename)
-            inputs[i] = feature_matrix
-            targets[i] = np.full((len(feature_matrix),), labels[target_key], dtype = np.int32)
-        except IOError:
-            pass
-    pickle.dump([inputs, targets], open("temp", "wb"))
+FEATURES_PATH = "dataset_frames"
+
+def saveFeatures(dataset, n_jobs = 4, retry_failed = False):
+    entries = [(i, getDatasetPath(entry[3]), labels[entry[2]]) for i, entry in dataset.items()]
+    DatasetBuilder(FEATURES_PATH).build(entries, extractFeatures, n_jobs = n_jobs,
+        retry_failed = retry_failed)
 
 def train():
-    temps = pickle.load(open("temp", "rb"))
-    X, targets = temps[0], temps[1]
+    dataset = Dataset(FEATURES_PATH)
     train_X, train_y = list(), list()
     for i in TRAINING_SET:
-        try:
-            print(targets[i][0], i)
-            train_X.append(X[i])
-            train_y.append(targets[i])
-        except KeyError:
-            pass
+        if i in dataset:
+            X, y = dataset.getFile(i)
+            print(y[0], i)
+            train_X.append(np.asarray(X))
+            train_y.append(np.asarray(y))
     for i in range(len(train_y)):
         key_counters[key_names[train_y[i][0]]] += 1
     print(key_counters)
@@ -136,16 +128,13 @@ def predict():
     model = HMM(5, has_io = True, standardize = False)
     model.pyLoad("model")
 
-    temps = pickle.load(open("temp", "rb"))
-    X, targets = temps[0], temps[1]
+    dataset = Dataset(FEATURES_PATH)
     validation_X, validation_y = list(), list()
     for i in range(490):
-        if i not in TRAINING_SET:        
-            try:
-                validation_X.append(X[i])
-                validation_y.append(targets[i])
-            except KeyError:
-                pass
+        if i not in TRAINING_SET and i in dataset:
+            X, y = dataset.getFile(i)
+            validation_X.append(np.asarray(X))
+            validation_y.append(np.asarray(y))
     tp, fp, relatives, parallels, out_by_a_fifth, out_by_a_fourth, n_total = 0, 0, 0, 0, 0, 0, 0
     distances = np.zeros(12)
     for i, entry in enumerate(validation_X):
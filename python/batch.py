@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# batch.py : Key detection of many signals through shared frame batches
+# author : Antoine Passemiers
+
+import numpy as np
+
+from cognitive import *
+from memory import getChunkSize, trackStage
+from spectral import LombScargleRegressor, TargetedDFTRegressor, VanicekRegressor, getPeriodogramFrames
+
+""" Per-process cache of precomputed kernels, indexed by spectral method """
+_kernels = dict()
+
+def getKernels(method):
+    """ Returns the precomputed kernels of a spectral method,
+    building them on first use """
+    config = (method, Parameters.window_size, Parameters.target_sampling_rate,
+        Parameters.min_midi_note, Parameters.max_midi_note)
+    if config not in _kernels:
+        if method == METHOD_CQT:
+            wins = getSpectralWindows(framerate = Parameters.target_sampling_rate)
+            _kernels[config] = (np.blackman(Parameters.window_size), getCQTKernel(wins))
+        elif method == METHOD_LOMB_SCARGLE:
+            _kernels[config] = LombScargleRegressor(
+                Parameters.window_size, Parameters.target_sampling_rate)
+        elif method == METHOD_VANICEK:
+            _kernels[config] = VanicekRegressor(
+                Parameters.window_size, Parameters.target_sampling_rate)
+        elif method == METHOD_TARGETED_DFT:
+            wins = getSpectralWindows(framerate = Parameters.target_sampling_rate)
+            _kernels[config] = TargetedDFTRegressor(Parameters.window_size, wins)
+        else:
+            raise ValueError("Unknown spectral method: %s" % str(method))
+    return _kernels[config]
+
+def getSignalFrames(signal, method):
+    """ Frames analysed by a spectral method, as the rows of a matrix """
+    if method in (METHOD_LOMB_SCARGLE, METHOD_VANICEK):
+        return getPeriodogramFrames(signal)
+    return getFrameMatrix(signal)
+
+def getFeatureMatrix(frames, method):
+    """ Spectral coefficients (one row per frame) of a matrix of frames """
+    if method == METHOD_CQT:
+        window, kernel = getKernels(method)
+        return np.dot(np.abs(np.fft.rfft(frames * window, axis = 1)), kernel)
+    return getKernels(method).fitMatrix(frames)
+
+def getFrameKeys(frames, method):
+    """ Index of the best matching key of every frame, -1 for silent frames """
+    scores = getProfileScores(getChromaticMatrix(getFeatureMatrix(frames, method)),
+        MAJOR_PROFILE_MATRIX, MINOR_PROFILE_MATRIX)
+    return getBestKeys(scores)
+
+def iterFrameBatches(frame_matrices, batch_frames):
+    """ Copies the rows of consecutive frame matrices into batches of exactly
+    batch_frames rows (except the last one). A batch may hold the frames of
+    several signals, and the frames of a signal may span several batches.
+    The batch buffer is reused, so each batch must be consumed before the
+    next one is requested. """
+    buf, n_rows = None, 0
+    for frames in frame_matrices:
+        if buf is None:
+            buf = np.empty((batch_frames, frames.shape[1]), dtype = np.double)
+        start = 0
+        while start < len(frames):
+            n = min(batch_frames - n_rows, len(frames) - start)
+            buf[n_rows:n_rows+n] = frames[start:start+n]
+            n_rows += n
+            start += n
+            if n_rows == batch_frames:
+                yield buf
+                n_rows = 0
+    if n_rows > 0:
+        yield buf[:n_rows]
+
+def scatterHistograms(frame_keys, counts):
+    """ Splits the keys of the concatenated frames into one 24-bin key
+    histogram per signal, given the number of frames of each signal.
+    Frames of key -1 are left out of the histograms. """
+    counts = np.asarray(counts, dtype = np.intp)
+    hists = np.zeros((len(counts), 24), dtype = int)
+    non_empty = counts > 0
+    if np.any(non_empty):
+        one_hot = np.zeros((len(frame_keys), 24), dtype = int)
+        voted = np.where(frame_keys >= 0)[0]
+        one_hot[voted, frame_keys[voted]] = 1
+        """ reduceat requires strictly increasing offsets : empty signals
+        are left out and keep an empty histogram """
+        offsets = (np.cumsum(counts) - counts)[non_empty]
+        hists[non_empty] = np.add.reduceat(one_hot, offsets, axis = 0)
+    return hists
+
+def findKeysInSignals(signals, method = METHOD_CQT, batch_frames = 2048, gate = False):
+    """ Predicts the keys of many signals at once.
+
+    The frames of all the signals are concatenated and processed by batches
+    of batch_frames rows, so that short signals share the FFT, kernel and
+    profile correlation calls of their neighbours instead of each paying
+    for a call of a few rows. Signals are consumed lazily : only the frames
+    of the current batch are copied in memory.
+
+    Parameters
+    ----------
+    signals : iterable
+        Mono signals, sampled at Parameters.target_sampling_rate
+    method : int
+        Spectral method (METHOD_CQT, METHOD_LOMB_SCARGLE, ...)
+    batch_frames : int
+        Maximum number of frames per batch, lowered if needed to fit in
+        Parameters.memory_budget
+    gate : bool
+        Whether silent and noisy frames are skipped (see getFrameGate)
+
+    Returns
+    -------
+    keys : list
+        Predicted key names, in the order of the signals
+    hists : np.ndarray[ndim = 2]
+        Key histograms, of shape (n_signals, 24)
+    """
+    """ A batch costs its buffer, its windowed copy and its spectra """
+    batch_frames = getChunkSize(3 * 8 * Parameters.window_size, batch_frames)
+    counts = list()
+    def iterFrames():
+        for signal in signals:
+            frames = getSignalFrames(signal, method)
+            if gate:
+                frames = frames[getFrameGate(frames)[0]]
+            counts.append(len(frames))
+            yield frames
+    with trackStage("spectrum"):
+        frame_keys = [getFrameKeys(batch, method) for batch in iterFrameBatches(iterFrames(), batch_frames)]
+    frame_keys = np.concatenate(frame_keys) if len(frame_keys) > 0 else np.empty(0, dtype = int)
+    hists = scatterHistograms(frame_keys, counts)
+    return [predictKeyFromHistogram(hist) for hist in hists], hists
+
+def analyseSignalBatch(signals, method, batch_frames = 2048, gate = False):
+    """ Predicts the keys of several signals at once and returns one
+    result record per signal """
+    keys, hists = findKeysInSignals(signals, method = method, batch_frames = batch_frames, gate = gate)
+    results = list()
+    for key, hist in zip(keys, hists):
+        n_frames = int(hist.sum())
+        if key is None:
+            results.append({ "error" : "ValueError: %s" % NO_FRAME_MESSAGE, "frames" : 0 })
+            continue
+        results.append({
+            "key" : key,
+            "confidence" : float(hist.max()) / n_frames if n_frames > 0 else 0.0,
+            "frames" : n_frames })
+    return results
+
+def analyseFileBatch(filenames, method = METHOD_CQT, batch_frames = 2048, gate = False):
+    """ Same as analyseSignalBatch for wav files. Files that cannot be
+    loaded get an error record instead of aborting the whole batch. """
+    signals, records = list(), list()
+    for filename in filenames:
+        try:
+            signals.append(loadSignal(filename))
+            records.append({ "file" : filename })
+        except Exception as e:
+            records.append({ "file" : filename, "error" : "%s: %s" % (type(e).__name__, str(e)) })
+    results = iter(analyseSignalBatch(signals, method, batch_frames = batch_frames, gate = gate))
+    for record in records:
+        if "error" not in record:
+            record.update(next(results))
+    return records
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# benchmarks.py : Timings of the alternative implementations
+# author : Antoine Passemiers
+
+import os, sys, time, itertools
+import numpy as np
+
+from cognitive import *
+from spectral import *
+
+class overrideParameters:
+    """ Temporarily replaces attributes of Parameters """
+    def __init__(self, **kwargs):
+        self.values = kwargs
+        self.backup = dict()
+    def __enter__(self):
+        for name, value in self.values.items():
+            self.backup[name] = getattr(Parameters, name)
+            setattr(Parameters, name, value)
+    def __exit__(self, *args):
+        for name, value in self.backup.items():
+            setattr(Parameters, name, value)
+
+def bestTime(func, *args, **kwargs):
+    """ Best wall-clock time (in seconds) out of a few runs """
+    n_runs = kwargs.pop("n_runs", 3)
+    best = np.inf
+    for _ in range(n_runs):
+        start = time.time()
+        func(*args, **kwargs)
+        best = min(best, time.time() - start)
+    return best
+
+def showTable(header, rows):
+    print(("%14s" * len(header)) % tuple(header))
+    for row in rows:
+        print("".join(("%14.4f" % v if v >= 1e-3 else "%14.2e" % v) if isinstance(v, float)
+            else "%14s" % str(v) for v in row))
+    print("")
+
+def benchTargetedDFT(duration = 30.0):
+    """ FFT + CQT versus DFT evaluated at the note bins only, for several
+    window sizes and note ranges. Times are in seconds per track. """
+    signal = np.random.RandomState(0).randn(int(duration * Parameters.target_sampling_rate))
+    rows = list()
+    for min_note, max_note in [(8, 80), (32, 56), (44, 56)]:
+        for window_size in [512, 1024, 2048, 4096]:
+            with overrideParameters(window_size = window_size, slide = window_size,
+                    min_midi_note = min_note, max_midi_note = max_note,
+                    n_octaves = (max_note - min_note) // 12):
+                wins = getSpectralWindows(framerate = Parameters.target_sampling_rate)
+                window, kernel = np.blackman(window_size), getCQTKernel(wins)
+                frames = getFrameMatrix(signal)
+                n_bins = len(TargetedDFTRegressor(window_size, wins).bins)
+                getTargetedDFTs(signal, wins) # Builds the cached kernels
+                rows.append((
+                    "%d-%d" % (min_note, max_note), window_size, n_bins,
+                    bestTime(lambda: getCQTs(getFFTs(signal), wins)),
+                    bestTime(lambda: np.dot(np.abs(np.fft.rfft(frames * window, axis = 1)), kernel)),
+                    bestTime(getTargetedDFTs, signal, wins),
+                    bestTime(getTargetedDFTs, signal, wins, mode = "goertzel", n_runs = 1)))
+    showTable(["notes", "window", "bins", "fft+cqt", "rfft+kernel", "dft gemm", "goertzel"], rows)
+
+def benchFastLombScargle(n_frames = 32):
+    """ Direct Lomb-Scargle sums versus the Press-Rybicki method, for
+    increasing numbers of frequencies. Times are in milliseconds per frame. """
+    frames = np.random.RandomState(0).randn(n_frames, Parameters.window_size)
+    rows = list()
+    for n_freqs in [72, 288, 1152]:
+        note_frequencies = np.geomspace(
+            Parameters.note_frequencies[0], Parameters.note_frequencies[-1], n_freqs)
+        with overrideParameters(note_frequencies = note_frequencies):
+            direct = LombScargleRegressor(Parameters.window_size, Parameters.target_sampling_rate)
+            fast = FastLombScargleRegressor(Parameters.window_size, Parameters.target_sampling_rate)
+            P, Q = direct.fitMatrix(frames), fast.fitMatrix(frames)
+            rows.append((n_freqs,
+                1000.0 * bestTime(lambda: [direct.fit(frame) for frame in frames]) / n_frames,
+                1000.0 * bestTime(direct.fitMatrix, frames) / n_frames,
+                1000.0 * bestTime(fast.fitMatrix, frames) / n_frames,
+                np.abs(P - Q).max() / P.max()))
+    showTable(["frequencies", "direct fit", "direct gemm", "press-rybicki", "max rel err"], rows)
+
+def benchVanicek(duration = 30.0):
+    """ Vaníček least squares spectra versus Lomb-Scargle periodograms, on the
+    same frames. Times are in seconds per track, sizes in megabytes. """
+    signal = np.random.RandomState(0).randn(int(duration * Parameters.target_sampling_rate))
+    frames = getPeriodogramFrames(signal)
+    lomb_scargle = LombScargleRegressor(Parameters.window_size, Parameters.target_sampling_rate)
+    vanicek = VanicekRegressor(Parameters.window_size, Parameters.target_sampling_rate)
+    ls_size = 2 * len(lomb_scargle.cos_waves) * Parameters.window_size * 8 / 1e6
+    vanicek_size = (vanicek.A.nbytes + vanicek.factor[0].nbytes) / 1e6
+    showTable(["method", "seconds", "kernel MB"], [
+        ("lomb-scargle", bestTime(getPeriodograms, signal.copy()), ls_size),
+        ("ls gemm", bestTime(lomb_scargle.fitMatrix, frames), ls_size),
+        ("vanicek", bestTime(vanicek.fitMatrix, frames), vanicek_size)])
+
+def benchKernels():
+    """ Compiled loops of kernels.py versus their NumPy/SciPy fallbacks.
+    Compilation is excluded from the timings. Times are in milliseconds. """
+    import kernels
+    from scipy.signal import butter
+    rng = np.random.RandomState(0)
+    b, a = butter(Parameters.lowpass_filter_order, 0.25)
+    blocks = np.array_split(rng.randn(int(30 * Parameters.sampling_rate)), 300)
+    def filterStream(use_kernel):
+        state = None
+        for block in blocks:
+            _, state = kernels.lfilter(b, a, block, zi = state, use_kernel = use_kernel)
+    frames = rng.randn(32, Parameters.window_size)
+    coefs = 2.0 * np.cos(2.0 * np.pi * np.arange(100, 400) / Parameters.window_size)
+    observations = rng.randint(0, 24, size = 100000)
+    cases = [
+        ("lfilter x300", filterStream, ()),
+        ("goertzel", lambda use_kernel: kernels.goertzelPower(frames, coefs, use_kernel = use_kernel), ()),
+        ("zcr", lambda use_kernel: kernels.zeroCrossingCounts(frames, use_kernel = use_kernel), ()),
+        ("transitions", lambda use_kernel: kernels.transitionCounts(observations, 3, use_kernel = use_kernel), ())]
+    rows = list()
+    for name, func, args in cases:
+        func(True) # Compilation
+        compiled, fallback = bestTime(func, True), bestTime(func, False)
+        rows.append((name, 1000.0 * compiled, 1000.0 * fallback, fallback / compiled))
+    print("Numba %s" % ("enabled" if kernels.HAS_NUMBA else "not available (pure Python loops)"))
+    showTable(["kernel", "compiled", "numpy", "speedup"], rows)
+
+def benchBatching(n_signals = 256, duration = 30.0):
+    """ Per-signal analysis versus frames of many signals concatenated into
+    shared batches, on a corpus of short previews. Times are in
+    milliseconds per signal (see test_batch.py for the correctness checks). """
+    from batch import findKeysInSignals
+    rng = np.random.RandomState(0)
+    signals = [rng.randn(int(duration * Parameters.target_sampling_rate)) for _ in range(n_signals)]
+    rows = list()
+    for name, method in [("cqt", METHOD_CQT), ("dft", METHOD_TARGETED_DFT), ("lomb-scargle", METHOD_LOMB_SCARGLE)]:
+        row = [name, 1000.0 * bestTime(lambda: [findKeysInSignals([signal], method)
+            for signal in signals]) / n_signals]
+        for batch_frames in [256, 1024, 4096]:
+            row.append(1000.0 * bestTime(findKeysInSignals, signals, method,
+                batch_frames = batch_frames) / n_signals)
+        rows.append(row)
+    showTable(["method", "per signal", "batch 256", "batch 1024", "batch 4096"], rows)
+
+def benchPipeline(n_files = 24, duration = 30.0):
+    """ Sequential decoding and analysis versus the overlapped pipeline, on
+    synthetic wav files. Times are in seconds for the whole set of files. """
+    import io, tempfile
+    from scipy.io.wavfile import write as scipy_write
+    from neuhon import run, DECISION_HISTOGRAM
+    from pipeline import AnalysisPipeline
+    class NullWriter:
+        def write(self, record):
+            assert "error" not in record
+    rng = np.random.RandomState(0)
+    folder = tempfile.mkdtemp()
+    filenames = list()
+    for i in range(n_files):
+        signal = (rng.randn(int(duration * Parameters.sampling_rate), 2) * 3000).astype(np.int16)
+        filenames.append(os.path.join(folder, "%03d.wav" % i))
+        scipy_write(filenames[-1], int(Parameters.sampling_rate), signal)
+    rows = list()
+    for n_jobs in sorted(set([1, os.cpu_count() or 1])):
+        rows.append(("sequential", n_jobs, "-",
+            bestTime(run, filenames, NullWriter(), n_jobs = n_jobs, n_runs = 1)))
+        for n_readers in [1, 2]:
+            pipeline = AnalysisPipeline(n_jobs = n_jobs, n_readers = n_readers, max_duration = duration)
+            rows.append(("pipeline", n_jobs, n_readers,
+                bestTime(lambda: list(pipeline.run(filenames)), n_runs = 1)))
+            report = pipeline.getReport()
+            print("jobs %d, readers %d : %s" % (n_jobs, n_readers, str(report["utilisation"])))
+    showTable(["mode", "jobs", "readers", "seconds"], rows)
+
+def benchCascade(n_signals = 24, duration = 180.0):
+    """ Full analysis of every track versus the coarse-to-fine cascade, on
+    synthetic tracks (tonic triad and scale notes) with increasing amounts
+    of noise. Agreement is measured against the full analysis. """
+    rng = np.random.RandomState(0)
+    time_axis = np.arange(int(duration * Parameters.target_sampling_rate)) / Parameters.target_sampling_rate
+    signals = list()
+    for i in range(n_signals):
+        tonic = 48 + rng.randint(12)
+        notes = tonic + np.array([0, 4, 7, 0, 2, 4, 5, 7, 9, 11])[rng.randint(0, 10, size = 6)]
+        signal = sum(np.sin(2.0 * np.pi * midiToHertz(note) * time_axis) for note in notes)
+        signals.append(signal + 2.0 * i / n_signals * np.sqrt(len(notes)) * rng.randn(len(time_axis)))
+    start = time.time()
+    full_keys = [findKeyInSignal(signal)[0] for signal in signals]
+    full_time = time.time() - start
+    rows = list()
+    for min_margin in [0.1, 0.2, 0.4]:
+        with overrideParameters(cascade_min_hist_margin = min_margin):
+            start = time.time()
+            results = [findKeyInSignal(signal, cascade = True) for signal in signals]
+            cascade_time = time.time() - start
+        escalated = np.mean([extra.escalated for _, _, _, extra in results])
+        agreement = np.mean([key == full_key for (key, _, _, _), full_key in zip(results, full_keys)])
+        rows.append((min_margin, escalated, agreement, full_time, cascade_time, full_time / cascade_time))
+    showTable(["min margin", "escalated", "agreement", "full (s)", "cascade (s)", "speedup"], rows)
+
+def benchGating(n_signals = 16, duration = 120.0):
+    """ Spectral analysis of every frame versus gated frames, on synthetic
+    tracks with a silent intro and outro, silent gaps and noise bursts
+    (drums). The reference keys are those found by the same method in the
+    clean tracks, and scores are MIREX scores against them. """
+    rng = np.random.RandomState(0)
+    n_samples = int(duration * Parameters.target_sampling_rate)
+    time_axis = np.arange(n_samples) / Parameters.target_sampling_rate
+    clean_signals, signals = list(), list()
+    for i in range(n_signals):
+        tonic = 48 + rng.randint(12)
+        notes = tonic + np.array([0, 4, 7, 0, 2, 4, 5, 7, 9, 11])[rng.randint(0, 10, size = 6)]
+        clean = sum(np.sin(2.0 * np.pi * midiToHertz(note) * time_axis) for note in notes)
+        clean += 0.5 * rng.randn(n_samples)
+        signal = clean.copy()
+        segment = n_samples // 10
+        signal[:segment] = 0.0
+        signal[-segment:] = 0.0
+        for start in rng.randint(segment, n_samples - 2 * segment, size = 3):
+            signal[start:start+segment//4] = 0.0
+            burst = rng.randint(segment, n_samples - 2 * segment)
+            signal[burst:burst+segment//2] = 6.0 * rng.randn(segment // 2)
+        clean_signals.append(clean)
+        signals.append(signal)
+    rows = list()
+    for name, method in [("cqt", METHOD_CQT), ("lomb-scargle", METHOD_LOMB_SCARGLE)]:
+        reference = [findKeyInSignal(signal, method = method)[0] for signal in clean_signals]
+        for gate in [False, True]:
+            start = time.time()
+            results = [findKeyInSignal(signal, method = method, gate = gate) for signal in signals]
+            elapsed = time.time() - start
+            skipped = np.mean([1.0 - extra.gate_mask.mean() for _, _, _, extra in results]) if gate else 0.0
+            rows.append((name, str(gate), skipped,
+                getMIREXScore([key for key, _, _, _ in results], reference), elapsed))
+    showTable(["method", "gate", "skipped", "mirex", "seconds"], rows)
+
+def benchMemory(duration = 300.0):
+    """ Peak traced memory of each stage (in megabytes) and time (in seconds)
+    of the analysis of a long wav file, with and without memory budget """
+    import tempfile, memory
+    from scipy.io.wavfile import write as scipy_write
+    filename = os.path.join(tempfile.mkdtemp(), "long.wav")
+    signal = (np.random.RandomState(0).randn(int(duration * Parameters.sampling_rate), 2) * 3000).astype(np.int16)
+    scipy_write(filename, int(Parameters.sampling_rate), signal)
+    del signal
+    def fullRateLoad():
+        """ Loading as before : full-rate float64 mono signal, then decimation """
+        signal = stereoToMono(getSignalFromFile(filename))
+        return downSampling(signal, framerate = Parameters.target_sampling_rate)
+    rows = list()
+    memory.startTracking()
+    with memory.trackStage("decode"):
+        fullRateLoad()
+    rows.append(("full rate", "-", memory.stopTracking()["peak_mb"], 0.0, 0.0, 0.0))
+    for name, method in [("cqt", METHOD_CQT), ("dft", METHOD_TARGETED_DFT), ("vanicek", METHOD_VANICEK)]:
+        findKey(filename, method = method) # Builds the cached kernels
+        for budget in [None, 16, 8]:
+            with overrideParameters(memory_budget = None if budget is None else budget * 1024 * 1024):
+                start = time.time()
+                memory.startTracking()
+                findKey(filename, method = method)
+                report = memory.stopTracking()
+                stages = report["stages_mb"]
+                rows.append((name, str(budget), stages["decode"], stages["spectrum"],
+                    report["peak_mb"], time.time() - start))
+    showTable(["method", "budget MB", "decode", "spectrum", "peak", "seconds"], rows)
+
+def benchSweep(n_files = 8, duration = 60.0):
+    """ Grid of hyper-parameters evaluated with shared stages versus each
+    configuration run on its own, on synthetic wav files (tonic triad and
+    scale notes). Labels are the keys found by the default analysis, so
+    scores are MIREX scores against it. Times are in seconds. """
+    import tempfile
+    from scipy.io.wavfile import write as scipy_write
+    from sweep import runSweep
+    rng = np.random.RandomState(0)
+    time_axis = np.arange(int(duration * Parameters.sampling_rate)) / Parameters.sampling_rate
+    folder = tempfile.mkdtemp()
+    entries = list()
+    for i in range(n_files):
+        tonic = 48 + rng.randint(12)
+        notes = tonic + np.array([0, 4, 7, 0, 2, 4, 5, 7, 9, 11])[rng.randint(0, 10, size = 6)]
+        signal = sum(np.sin(2.0 * np.pi * midiToHertz(note) * time_axis) for note in notes)
+        signal = signal / len(notes) + 0.2 * rng.randn(len(time_axis))
+        filename = os.path.join(folder, "%03d.wav" % i)
+        scipy_write(filename, int(Parameters.sampling_rate),
+            (np.stack([signal, signal], axis = 1) * 8000).astype(np.int16))
+        entries.append((i, filename, KEY_DICT[findKey(filename)[0]]))
+    grid = { "window_size" : [2048, 4096], "chromatic_max_weight" : [0.0, 0.5],
+        "method" : ["cqt", "dft"], "profiles" : ["custom", "krumhansl", "shaath"] }
+    results, report = runSweep(entries, grid)
+    start = time.time()
+    configs = [dict(zip(sorted(grid.keys()), values)) for values in itertools.product(
+        *[grid[name] for name in sorted(grid.keys())])]
+    for config, row in zip(configs, results):
+        single, _ = runSweep(entries, { name : [value] for name, value in config.items() })
+        assert single[0]["mirex"] == row["mirex"]
+    unshared_time = time.time() - start
+    """ A configuration that fails on every file scores 0 without aborting the others """
+    PROFILE_SETS["broken"] = (np.ones(11), np.ones(11))
+    try:
+        partial, _ = runSweep(entries, { "profiles" : ["custom", "broken"] })
+    finally:
+        del PROFILE_SETS["broken"]
+    assert partial[0]["mirex"] == 1.0 and partial[0]["errors"] == 0
+    assert partial[1]["mirex"] == 0.0 and partial[1]["errors"] == n_files
+    best = max(results, key = lambda row : row["mirex"])
+    showTable(["configs", "stages", "unshared", "best mirex", "shared (s)", "unshared (s)", "speedup"],
+        [(len(results), report["stages"], report["unshared_stages"], best["mirex"],
+        report["seconds"], unshared_time, unshared_time / report["seconds"])])
+
+BENCHMARKS = {
+    "sweep" : benchSweep,
+    "memory" : benchMemory,
+    "gating" : benchGating,
+    "cascade" : benchCascade,
+    "batching" : benchBatching,
+    "targeted-dft" : benchTargetedDFT,
+    "fast-lomb-scargle" : benchFastLombScargle,
+    "vanicek" : benchVanicek,
+    "kernels" : benchKernels,
+    "pipeline" : benchPipeline }
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else sorted(BENCHMARKS.keys())
+    for name in names:
+        print("=== %s ===" % name)
+        BENCHMARKS[name]()
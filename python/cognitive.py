@@ -4,12 +4,13 @@
 
 import os, operator, pickle
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.io.wavfile import read as scipy_read
 from scipy.signal import butter, lfilter, freqz
 from scipy.stats import pearsonr
 from scipy.spatial.distance import cosine as cosine_similarity
 
+import kernels
+from memory import trackStage, processInChunks
 from bontempo import *
 from utils import *
 from spectral import *
@@ -20,9 +21,14 @@ WAV_PATH = "D://KeyFinderDB"
 
 METHOD_CQT          = 0xA86F20
 METHOD_LOMB_SCARGLE = 0xA86F21
+METHOD_TARGETED_DFT = 0xA86F22
+METHOD_VANICEK      = 0xA86F23
+
+""" Error of the signals where no frame voted for a key """
+NO_FRAME_MESSAGE = "No frame to analyse (signal shorter than a window, or silent)"
 
 def createProfileMatrix(profile):
-    mat = np.empty((12, 12), dtype = np.float)
+    mat = np.empty((12, 12), dtype = np.double)
     for i in range(0, 12):
         mat[i, :] = np.roll(profile, i)
     return mat
@@ -96,10 +102,27 @@ CUSTOM_MINOR_BASE_PROFILE = CUSTOM_MINOR_BASE_PROFILE_4096_CQT
 MAJOR_PROFILE_MATRIX = createProfileMatrix(CUSTOM_MAJOR_BASE_PROFILE)
 MINOR_PROFILE_MATRIX = createProfileMatrix(CUSTOM_MINOR_BASE_PROFILE)
 
+""" Base profiles (major, minor) by name, for comparing them (see sweep.py) """
+PROFILE_SETS = {
+    "custom"               : (CUSTOM_MAJOR_BASE_PROFILE, CUSTOM_MINOR_BASE_PROFILE),
+    "krumhansl"            : (KRUMHANSL_MAJOR_BASE_PROFILE, KRUMHANSL_MINOR_BASE_PROFILE),
+    "shaath"               : (SHAATH_MAJOR_BASE_PROFILE, SHAATH_MINOR_BASE_PROFILE),
+    "custom-4096"          : (CUSTOM_MAJOR_BASE_PROFILE_4096, CUSTOM_MINOR_BASE_PROFILE_4096),
+    "custom-8192"          : (CUSTOM_MAJOR_BASE_PROFILE_8192, CUSTOM_MINOR_BASE_PROFILE_8192),
+    "custom-12288"         : (CUSTOM_MAJOR_BASE_PROFILE_12288, CUSTOM_MINOR_BASE_PROFILE_12288),
+    "custom-16384"         : (CUSTOM_MAJOR_BASE_PROFILE_16384, CUSTOM_MINOR_BASE_PROFILE_16384),
+    "custom-4096-overlap2" : (CUSTOM_MAJOR_BASE_PROFILE_4096_OVERLAP2, CUSTOM_MINOR_BASE_PROFILE_4096_OVERLAP2) }
+
 class ExtraFeatures:
     def __init__(self):
         self.ZCR = None
         self.STE = None
+        self.obs_seq = None
+        self.chromatic_matrix = None
+        self.escalated = None
+        self.coarse_margin = None
+        self.flatness = None
+        self.gate_mask = None
 
 def w_xk(x, lk, rk):
     return 1.0 - np.cos(2 * np.pi * (x - lk) / (rk - lk))
@@ -120,9 +143,20 @@ def findNearestBoundsInSpectrum(fft_freqs, lk, rk):
         ri += 1
     return li, ri
 
-def getSignalFromFile(filename):
-    filepath = os.path.join(WAV_PATH, filename)
-    framerate, signal = scipy_read(filepath)
+def getDatasetPath(filename):
+    """ Path of a file of the dataset, whose CSV file gives paths relative to WAV_PATH """
+    return os.path.join(WAV_PATH, filename)
+
+def getSignalFromFile(filename, mmap = False):
+    """ Reads a wav file, whose path is opened as given. If mmap is True, the
+    samples are memory-mapped when the format allows it (scipy cannot map
+    24-bit samples, which are then read in memory). """
+    try:
+        framerate, signal = scipy_read(filename, mmap = mmap)
+    except ValueError:
+        if not mmap:
+            raise
+        framerate, signal = scipy_read(filename)
     assert(framerate == Parameters.sampling_rate)
     assert(signal.shape[1] == Parameters.n_channels)
     return signal
@@ -140,21 +174,41 @@ def butter_lowpass_filter(data, cutoff, fs, order = Parameters.lowpass_filter_or
     nyquist = 0.5 * fs
     normal_cutoff = cutoff / nyquist
     b, a = butter(order, normal_cutoff, btype = 'low', analog = False)
-    return lfilter(b, a, data)
-
-def lowPassFiltering(signal):
-    signal = butter_lowpass_filter(
-        signal, 
-        Parameters.lowpass_filter_cutoff_freq, 
-        Parameters.sampling_rate
-    ) # Low-pass filtering # TODO : Fisher's filter
-    return signal
+    return kernels.lfilter(b, a, data)[0]
+
+class StreamingLowPassFilter:
+    """ Low-pass filter applied to a stream block by block : the state of
+    the filter at the end of a block is the initial state of the next one,
+    so the output is the same as filtering the whole signal at once. """
+    def __init__(self, cutoff = None, fs = None, order = None):
+        cutoff = Parameters.lowpass_filter_cutoff_freq if cutoff is None else cutoff
+        fs = Parameters.sampling_rate if fs is None else fs
+        order = Parameters.lowpass_filter_order if order is None else order
+        nyquist = 0.5 * fs
+        self.b, self.a = butter(order, cutoff / nyquist, btype = 'low', analog = False)
+        self.state = None
+    def filter(self, block):
+        filtered, self.state = kernels.lfilter(self.b, self.a, block, zi = self.state)
+        return filtered
+
+def lowPassFiltering(signal, block_size = 65536):
+    """ Low-pass filters a mono signal block by block (see StreamingLowPassFilter),
+    so that the temporaries of the filter never exceed one block """
+    lowpass = StreamingLowPassFilter() # TODO : Fisher's filter
+    filtered = np.empty(len(signal), dtype = np.double)
+    for start in range(0, len(signal), block_size):
+        filtered[start:start+block_size] = lowpass.filter(signal[start:start+block_size])
+    return filtered
 
 def downSampling(signal, framerate = 4410.0):
+    step = float(Parameters.sampling_rate) / framerate
+    if step == int(step):
+        """ Same samples as below, without materializing the indexes """
+        return signal[::int(step)]
     indexes = np.asarray(np.arange(
         0, len(signal), 
-        float(Parameters.sampling_rate) / framerate
-    ), dtype = np.int)
+        step
+    ), dtype = int)
     signal = signal[indexes]
     return signal
 
@@ -173,20 +227,64 @@ def getSpectralWindows(framerate = 4410.0):
     return wins
 
 def getSTEandZCRs(signal):
-    i, n_vectors = 0, 0
-    n_samples = len(signal)
-    T = n_samples - Parameters.window_size
-    blackman_win = np.blackman(Parameters.window_size)
-    ste_sequence = np.empty(T / Parameters.window_size + 1, dtype = np.double)
-    zcr_sequence = np.empty(T / Parameters.window_size + 1, dtype = np.double)
-    while i < T:
-        frame = blackman_win * signal[i:i+Parameters.window_size]
-        ste_sequence[n_vectors] = (frame ** 2).sum()
-        zcr_sequence[n_vectors] = len(np.where(np.diff(np.signbit(signal)))[0])
-        i += Parameters.window_size
-        n_vectors += 1
+    """ Short-term energy and number of zero crossings of each frame """
+    return getFrameSTEandZCRs(getFrameMatrix(signal))
+
+def getFrameSTEandZCRs(frames):
+    blackman_win = np.blackman(frames.shape[1])
+    ste_sequence = ((blackman_win * frames) ** 2).sum(axis = 1)
+    zcr_sequence = kernels.zeroCrossingCounts(frames).astype(np.double)
     return ste_sequence, zcr_sequence
 
+def getSpectralFlatness(frames, decimation = None):
+    """ Ratio between the geometric and the arithmetic means of the power
+    spectrum of each frame : close to 0 for tonal frames, around 0.5 for
+    white noise. Frames are decimated first, which is enough to tell
+    tones from noise and makes the FFTs much smaller. """
+    decimation = Parameters.gate_decimation if decimation is None else decimation
+    decimated = frames[:, ::decimation]
+    power = np.abs(np.fft.rfft(decimated * np.blackman(decimated.shape[1]), axis = 1)[:, 1:]) ** 2
+    power += 1e-12 * (power.max(axis = 1)[:, np.newaxis] + 1e-12)
+    return np.exp(np.log(power).mean(axis = 1)) / power.mean(axis = 1)
+
+def getGateFeatures(frames):
+    """ Short-term energy, zero crossings and spectral flatness of each frame """
+    ste_sequence, zcr_sequence = getFrameSTEandZCRs(frames)
+    return ste_sequence, zcr_sequence, getSpectralFlatness(frames)
+
+def getFrameGate(frames):
+    """ Selects the frames worth a spectral analysis, with thresholds adapted
+    to the track : frames are dropped if they are silent compared to the
+    median energy of the track, or if they are both flat and crossing-rich
+    compared to the median frame (noise, drums). Silent frames are always
+    dropped, noisy frames only if enough frames remain.
+
+    Returns
+    -------
+    mask : np.ndarray[ndim = 1]
+        Whether each frame is kept
+    ste_sequence, zcr_sequence, flatness : np.ndarray[ndim = 1]
+        Short-term energy, zero crossings and spectral flatness of each frame
+    """
+    ste_sequence, zcr_sequence, flatness = getGateFeatures(frames)
+    return getGateMask(ste_sequence, zcr_sequence, flatness), ste_sequence, zcr_sequence, flatness
+
+def getGateMask(ste_sequence, zcr_sequence, flatness):
+    """ Thresholds of getFrameGate, given the features of all the frames """
+    if len(ste_sequence) == 0:
+        return np.ones(0, dtype = bool)
+    audible = ste_sequence > Parameters.gate_energy_ratio * np.median(ste_sequence)
+    if not np.any(audible):
+        return np.ones(len(ste_sequence), dtype = bool)
+    median = np.median(flatness[audible])
+    deviation = np.median(np.abs(flatness[audible] - median))
+    threshold = max(Parameters.gate_min_flatness, median + Parameters.gate_flatness_deviations * deviation)
+    noisy = (flatness > threshold) & (zcr_sequence > np.median(zcr_sequence[audible]))
+    mask = audible & ~noisy
+    if mask.sum() < Parameters.gate_min_kept * audible.sum():
+        mask = audible
+    return mask
+
 def getFFTs(signal, ticks = None):
     i, n_vectors = 0, 0
     n_coefs = Parameters.window_size
@@ -194,7 +292,7 @@ def getFFTs(signal, ticks = None):
     T = n_samples - Parameters.window_size
     blackman_win = np.blackman(Parameters.window_size)
     if ticks is None:
-        fft_matrix = np.empty((T / Parameters.window_size + 1, n_coefs), dtype = np.double)
+        fft_matrix = np.empty((T // Parameters.window_size + 1, n_coefs), dtype = np.double)
         while i < T:
             frame = blackman_win * signal[i:i+Parameters.window_size]
             i += Parameters.window_size
@@ -209,7 +307,7 @@ def getFFTs(signal, ticks = None):
                 pass
             fft_matrix[n_vectors, :] = np.abs(np.fft.fft(frame))
             n_vectors += 1
-    return fft_matrix
+    return fft_matrix[:n_vectors]
 
 def getCQTs(fft_matrix, wins):
     n_vectors = 0
@@ -222,12 +320,99 @@ def getCQTs(fft_matrix, wins):
         n_vectors += 1
     return cqt_matrix
 
+def getFrameMatrix(signal, window_size = None, slide = None):
+    """ Returns the frames used by getFFTs as the rows of a read-only matrix """
+    window_size = Parameters.window_size if window_size is None else window_size
+    slide = window_size if slide is None else slide
+    n_frames = max(0, -(-(len(signal) - window_size) // slide))
+    if n_frames == 0:
+        return np.empty((0, window_size), dtype = np.double)
+    frames = np.lib.stride_tricks.sliding_window_view(signal, window_size)
+    return frames[:n_frames * slide:slide]
+
+def getCQTKernel(wins, window_size = None):
+    """ Gathers the spectral windows into a matrix K such that the CQTs of
+    a matrix of spectra are given by np.dot(fft_matrix[:, :len(K)], K) """
+    window_size = Parameters.window_size if window_size is None else window_size
+    kernel = np.zeros((window_size // 2 + 1, len(wins)), dtype = np.double)
+    for k, (li, ri, win) in enumerate(wins):
+        assert(ri < len(kernel))
+        kernel[li:ri+1, k] = win
+    return kernel
+
+def getChromaticMatrix(feature_matrix):
+    """ Folds the spectral coefficients of each frame into 12 pitch classes """
+    coefs = np.reshape(feature_matrix, (len(feature_matrix), Parameters.n_octaves, 12))
+    p = Parameters.chromatic_max_weight
+    return p * coefs.max(axis = 1) + (1.0 - p) * coefs.sum(axis = 1)
+
+def getProfileScores(chromatic_matrix, major_profile_matrix, minor_profile_matrix):
+    """ Pearson correlation coefficients between every chromatic vector and
+    every tone profile. Column kk of the result holds the scores of the key
+    that matchWithProfiles would predict as kk. Constant chromatic vectors
+    (e.g. silent frames) correlate with no profile : their rows are NaN. """
+    def standardize(mat):
+        mat = mat - mat.mean(axis = 1)[:, np.newaxis]
+        norms = np.sqrt((mat ** 2).sum(axis = 1))[:, np.newaxis]
+        return mat / np.where(norms > 0, norms, 1.0)
+    chromatic_matrix = np.asarray(chromatic_matrix, dtype = np.double)
+    coefs = standardize(chromatic_matrix)
+    keys = (Parameters.min_midi_note - 1 + np.arange(12)) % 12
+    scores = np.empty((len(coefs), 24), dtype = np.double)
+    scores[:, keys + 12] = np.dot(coefs, standardize(major_profile_matrix).T)
+    scores[:, keys] = np.dot(coefs, standardize(minor_profile_matrix).T)
+    scores[isConstant(chromatic_matrix)] = np.nan
+    return scores
+
+def getBestKeys(scores):
+    """ Index of the best matching key of every row of profile scores,
+    or -1 for the frames without scores (see getProfileScores) """
+    keys = np.full(len(scores), -1, dtype = int)
+    scored = ~np.isnan(scores).any(axis = 1)
+    keys[scored] = scores[scored].argmax(axis = 1)
+    return keys
+
+def getKeyHistogram(keys):
+    """ Number of frames voting for each key, frames of index -1 left out """
+    keys = np.asarray(keys, dtype = int)
+    return np.bincount(keys[keys >= 0], minlength = 24)
+
+_targeted_dft_regressors = dict()
+
+def getTargetedDFTs(signal, wins, mode = "gemm", mask = None):
+    """ Same coefficients as getCQTs(getFFTs(signal), wins), computed
+    without evaluating the whole spectrum of each frame. If mask is given,
+    only the frames for which it is True are analysed. """
+    config = (Parameters.window_size, mode, tuple((li, ri) for li, ri, _ in wins))
+    if config not in _targeted_dft_regressors:
+        _targeted_dft_regressors[config] = TargetedDFTRegressor(Parameters.window_size, wins, mode = mode)
+    regressor = _targeted_dft_regressors[config]
+    frames = getFrameMatrix(signal)
+    rows = np.arange(len(frames)) if mask is None else np.where(mask)[0]
+    """ A chunk costs a windowed copy of its frames and the real part,
+    imaginary part and magnitude of each targeted bin """
+    return processInChunks(lambda chunk: regressor.fitMatrix(frames[rows[chunk]]), len(rows), len(wins),
+        8 * (2 * Parameters.window_size + 4 * len(regressor.bins)), reserved = signal.nbytes)
+
+def isConstant(chromatic_matrix):
+    """ Whether each row of a chromatic matrix has all its coefficients equal,
+    the case where the Pearson correlation with a profile is undefined """
+    chromatic_matrix = np.atleast_2d(chromatic_matrix)
+    return np.all(chromatic_matrix == chromatic_matrix[:, :1], axis = 1)
+
 def predictKeyFromHistogram(hist):
+    """ Most voted key, or None if no frame voted (e.g. a silent signal) """
+    if np.sum(hist) == 0:
+        return None
     kk = np.argmax(hist)
     predicted_key_name = KEY_NAMES[kk]
     return predicted_key_name
 
 def matchWithProfiles(coefs, major_profile_matrix, minor_profile_matrix):
+    """ Index of the best matching key, or None for a constant chromatic
+    vector (e.g. a silent frame), which gives no vote """
+    if isConstant(coefs)[0]:
+        return None
     major_scores, minor_scores = np.zeros(12), np.zeros(12)
     for j in range(12):
         major_scores[j] = pearsonr(coefs, major_profile_matrix[j])[0]
@@ -242,64 +427,160 @@ def matchWithProfiles(coefs, major_profile_matrix, minor_profile_matrix):
         kk = (Parameters.min_midi_note - 1 + best_minor_key) % 12
     return kk
 
-def findKey(filename, method = METHOD_CQT):
-    hist = np.zeros(24, dtype = np.int)
-    """ Loading wav file """
-    stereo_signal = getSignalFromFile(filename)
-    """ Averaging the 2 channels (stereo -> mono) """
-    signal = stereoToMono(stereo_signal) # Mean of left and right channels
-    """ Low-pass filtering """
-    # signal = lowPassFiltering(signal)
-    # signal = moving_average(signal)
-    """ Downsampling """
-    signal = downSampling(signal, framerate = Parameters.target_sampling_rate)
+def loadSignal(filename):
+    with trackStage("decode"):
+        """ Loading wav file (memory-mapped : only the kept samples are read) """
+        stereo_signal = getSignalFromFile(filename, mmap = True)
+        """ Low-pass filtering """
+        # signal = lowPassFiltering(signal)
+        # signal = moving_average(signal)
+        """ Downsampling, then averaging the 2 channels (stereo -> mono). Picking
+        samples before averaging gives the same signal without ever holding
+        the full-rate signal in memory as floating point numbers. """
+        signal = downSampling(stereo_signal, framerate = Parameters.target_sampling_rate)
+        return stereoToMono(np.asarray(signal)) # Mean of left and right channels
+
+_cqt_kernels = dict()
+
+def getCachedCQTKernel():
+    config = (Parameters.window_size, Parameters.target_sampling_rate,
+        Parameters.min_midi_note, Parameters.max_midi_note)
+    if config not in _cqt_kernels:
+        wins = getSpectralWindows(framerate = Parameters.target_sampling_rate)
+        _cqt_kernels[config] = (np.blackman(Parameters.window_size), getCQTKernel(wins))
+    return _cqt_kernels[config]
+
+def getKeyMargin(values):
+    """ Difference between the two largest values : as a fraction of the
+    frames for a histogram, in correlation units for profile scores """
+    top = np.sort(values)[-2:]
+    if Parameters.cascade_margin_type == "hist":
+        return float(top[1] - top[0]) / max(1, values.sum())
+    return float(top[1] - top[0])
+
+def findKeyByCascade(signal, method = METHOD_CQT, gate = False):
+    """ Coarse-to-fine key detection : a cheap pass first analyses one frame
+    out of Parameters.cascade_frame_step with the vectorized CQT, and the
+    full analysis with the given method only runs if the margin between the
+    two best keys of the cheap pass is too small to trust it. """
+    window, kernel = getCachedCQTKernel()
+    frames = getFrameMatrix(signal)[::Parameters.cascade_frame_step]
+    feature_matrix = np.dot(np.abs(np.fft.rfft(frames * window, axis = 1)), kernel)
+    chromatic_matrix = getChromaticMatrix(feature_matrix)
+    scores = getProfileScores(chromatic_matrix, MAJOR_PROFILE_MATRIX, MINOR_PROFILE_MATRIX)
+    obs_seq = getBestKeys(scores)
+    obs_seq = obs_seq[obs_seq >= 0]
+    hist = getKeyHistogram(obs_seq)
+    if Parameters.cascade_margin_type == "hist":
+        margin, min_margin = getKeyMargin(hist), Parameters.cascade_min_hist_margin
+    else:
+        scored = scores[~np.isnan(scores).any(axis = 1)]
+        margin = getKeyMargin(scored.mean(axis = 0)) if len(scored) > 0 else 0.0
+        min_margin = Parameters.cascade_min_score_margin
+
+    """ Silent frames have no vote and do not count towards cascade_min_frames """
+    if len(obs_seq) < Parameters.cascade_min_frames or margin < min_margin:
+        predicted_key_name, feature_matrix, hist, extra_features = findKeyInSignal(
+            signal, method = method, gate = gate)
+        extra_features.escalated = True
+    else:
+        predicted_key_name = predictKeyFromHistogram(hist)
+        extra_features = ExtraFeatures()
+        extra_features.obs_seq = list(obs_seq)
+        extra_features.chromatic_matrix = chromatic_matrix
+        extra_features.escalated = False
+    extra_features.coarse_margin = margin
+    return predicted_key_name, feature_matrix, hist, extra_features
+
+def findKeyInSignal(signal, method = METHOD_CQT, cascade = False, gate = False):
+    if cascade:
+        return findKeyByCascade(signal, method = method, gate = gate)
+    hist = np.zeros(24, dtype = int)
     """ Spectral windows for getting CQT from real spectrum """
     wins = getSpectralWindows(framerate = Parameters.target_sampling_rate)
-    """ Computing Short-Term Energies """
-    # ste_sequence, zcr_sequence = getSTEandZCRs(signal)
     extra_features = ExtraFeatures()
-    # extra_features.STE = ste_sequence
-    # extra_features.ZCR = zcr_sequence
-
-    chromatic_matrices = list()
-    if method == METHOD_CQT:
-        """ Computing real Fast Fourier Transforms """
-        fft_matrix = getFFTs(signal)
-        """ Computing Constant-Q Transforms """
-        feature_matrix = getCQTs(fft_matrix, wins)
-    elif method == METHOD_LOMB_SCARGLE:
-        """ Computing Lomb-Scargle periodograms """
-        feature_matrix = getPeriodograms(signal)
-        # print(list(feature_matrix[30]))
-
-    obs_seq = list()
-    n_samples = len(feature_matrix)
-    chromatic_matrix = np.empty((n_samples, 12), dtype = np.double)
-    
-    n_vectors = 0
-    while n_vectors < n_samples:
-        coefs = feature_matrix[n_vectors]
-        coefs = np.reshape(coefs, (Parameters.n_octaves, 12))
-        p = Parameters.chromatic_max_weight
-        coefs = p * coefs.max(axis = 0) + (1.0 - p) * coefs.sum(axis = 0)
-        chromatic_matrix[n_vectors, :] = coefs[:]
-
-        kk = matchWithProfiles(coefs, MAJOR_PROFILE_MATRIX, MINOR_PROFILE_MATRIX)
-        obs_seq.append(kk)
-        hist[kk] += 1
-        n_vectors += 1
-    print(obs_seq)
+    periodogram_method = method in (METHOD_LOMB_SCARGLE, METHOD_VANICEK)
+    n_frames = countPeriodogramFrames(signal) if periodogram_method else len(getFrameMatrix(signal))
+    mask = None
+    if gate:
+        """ Computing Short-Term Energies, ZCRs and spectral flatnesses
+        to skip silent and noisy frames in the spectral analysis """
+        with trackStage("gate"):
+            getFrames = getPeriodogramFrames if periodogram_method else \
+                (lambda signal, rows: getFrameMatrix(signal)[rows])
+            features = processInChunks(lambda chunk: np.stack(getGateFeatures(getFrames(signal, chunk)), axis = 1),
+                n_frames, 3, 8 * 4 * Parameters.window_size, reserved = signal.nbytes)
+            extra_features.STE, extra_features.ZCR, extra_features.flatness = features.T
+            mask = getGateMask(*features.T)
+            extra_features.gate_mask = mask
+    rows = np.arange(n_frames) if mask is None else np.where(mask)[0]
+
+    with trackStage("spectrum"):
+        if method == METHOD_CQT:
+            """ Computing real Fast Fourier Transforms and Constant-Q Transforms,
+            for as many frames at a time as the memory budget allows. Each FFT
+            also needs a windowed frame and a complex spectrum, one at a time. """
+            feature_matrix = processInChunks(
+                lambda chunk: getCQTs(getFFTs(signal, ticks = rows[chunk] * Parameters.window_size), wins),
+                len(rows), len(wins), 8 * (Parameters.window_size + len(wins)),
+                reserved = signal.nbytes + 8 * 3 * Parameters.window_size)
+        elif method == METHOD_LOMB_SCARGLE:
+            """ Computing Lomb-Scargle periodograms """
+            if mask is None:
+                feature_matrix = getPeriodograms(signal)
+            else:
+                regressor = LombScargleRegressor(Parameters.window_size, Parameters.target_sampling_rate)
+                feature_matrix = processInChunks(
+                    lambda chunk: regressor.fitMatrix(getPeriodogramFrames(signal, rows[chunk])),
+                    len(rows), len(Parameters.note_frequencies),
+                    8 * (3 * Parameters.window_size + 2 * len(Parameters.note_frequencies)), reserved = signal.nbytes)
+        elif method == METHOD_TARGETED_DFT:
+            """ Computing the DFT at the note frequencies only """
+            feature_matrix = getTargetedDFTs(signal, wins, mask = mask)
+        elif method == METHOD_VANICEK:
+            """ Computing Vaníček least squares spectra """
+            feature_matrix = getVanicekSpectra(signal, mask = mask)
+        else:
+            raise ValueError("Unknown spectral method: %s" % str(method))
+
+    with trackStage("match"):
+        obs_seq = list()
+        n_samples = len(feature_matrix)
+        chromatic_matrix = np.empty((n_samples, 12), dtype = np.double)
+
+        n_vectors = 0
+        while n_vectors < n_samples:
+            coefs = feature_matrix[n_vectors]
+            coefs = np.reshape(coefs, (Parameters.n_octaves, 12))
+            p = Parameters.chromatic_max_weight
+            coefs = p * coefs.max(axis = 0) + (1.0 - p) * coefs.sum(axis = 0)
+            chromatic_matrix[n_vectors, :] = coefs[:]
+
+            kk = matchWithProfiles(coefs, MAJOR_PROFILE_MATRIX, MINOR_PROFILE_MATRIX)
+            if kk is not None:
+                obs_seq.append(kk)
+                hist[kk] += 1
+            n_vectors += 1
     extra_features.obs_seq = obs_seq
-    print(hist.reshape(2, 12))
+    extra_features.chromatic_matrix = chromatic_matrix
     predicted_key_name = predictKeyFromHistogram(hist)
     return predicted_key_name, feature_matrix, hist, extra_features
 
+def findKey(filename, method = METHOD_CQT, cascade = False, gate = False):
+    return findKeyInSignal(loadSignal(filename), method = method, cascade = cascade, gate = gate)
+
 def findKeyUsingCQT(filename): 
     return findKey(filename, method = METHOD_CQT)
 
 def findKeyUsingLombScargle(filename): 
     return findKey(filename, method = METHOD_LOMB_SCARGLE)
 
+def findKeyUsingTargetedDFT(filename):
+    return findKey(filename, method = METHOD_TARGETED_DFT)
+
+def findKeyUsingVanicek(filename):
+    return findKey(filename, method = METHOD_VANICEK)
+
 def searchForBestProfile():
     dataset = pickle.load(open("profile_dataset.npy", "rb"))
 
@@ -317,16 +598,15 @@ def searchForBestProfile():
         p = np.random.rand(1)[0]
         print("p : %s" % str(p))
         for i, row in enumerate(dataset):
-            hist = np.zeros(24, dtype = np.int)
+            hist = np.zeros(24, dtype = int)
             (spectral_matrix, target_key) = row
             for j in range(len(spectral_matrix)):
                 coefs = spectral_matrix[j]
                 coefs = np.reshape(coefs, (Parameters.n_octaves, 12))
                 coefs = p * coefs.max(axis = 0) + (1.0 - p) * coefs.sum(axis = 0)
-                hist[matchWithProfiles(
-                    coefs,
-                    major_profile_matrix,
-                    minor_profile_matrix)] += 1
+                kk = matchWithProfiles(coefs, major_profile_matrix, minor_profile_matrix)
+                if kk is not None:
+                    hist[kk] += 1
             predicted_key = predictKeyFromHistogram(hist)
             distance = getDistance(predicted_key, target_key)
             distances[distance] += 1
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# dataset.py : Resumable on-disk training set builder
+# author : Antoine Passemiers
+
+import os, sys, json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import KEY_DICT
+from cognitive import CSV_PATH, WAV_PATH, findKeyUsingLombScargle
+
+def loadEntries(csv_path = CSV_PATH, n_files = None, wav_path = WAV_PATH):
+    """ Reads the dataset CSV file and returns (entry id, filename, label)
+    tuples, where the entry id is the row number of the file. Relative
+    filenames are relative to wav_path. """
+    entries = list()
+    with open(csv_path, "r") as csv_file:
+        csv_file.readline()
+        for i, line in enumerate(csv_file):
+            if n_files is not None and i >= n_files:
+                break
+            row = line.replace('\n', '').split(';')
+            artist, title, target_key, filename = row[0], row[1], row[2], row[3]
+            entries.append((i, os.path.join(wav_path, filename), KEY_DICT[target_key]))
+    return entries
+
+def extractKeyHistogram(filename):
+    """ Normalized key histogram of a file, as a single feature row """
+    _, _, vec, extra = findKeyUsingLombScargle(filename)
+    return (vec / float(np.sum(vec)))[np.newaxis, :]
+
+def extractEntry(extractor, entry_id, filename):
+    try:
+        return entry_id, extractor(filename), None
+    except Exception as e:
+        return entry_id, None, "%s: %s" % (type(e).__name__, str(e))
+
+class DatasetBuilder:
+    """ Appends the features of many files to a directory of .npy shards.
+
+    Each file yields a feature matrix (one row per frame, or a single row)
+    and all its rows share the label of the file. Rows are buffered until
+    shard_size rows are available, then written as a new shard together with
+    an updated index.json. A file is only marked as done once its rows are
+    in a shard, so an interrupted build resumes from the last shard. Files
+    whose extraction failed are recorded with their error, and are only
+    extracted again by a build with retry_failed = True.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the dataset, created if it does not exist
+    shard_size : int
+        Minimum number of rows per shard (except the last one)
+    dtype : np.dtype
+        Data type of the stored features
+    """
+    def __init__(self, path, shard_size = 65536, dtype = np.double):
+        self.path = path
+        self.shard_size = shard_size
+        self.dtype = dtype
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.index = loadIndex(path)
+        self.buffer_X, self.buffer_y, self.buffer_ids = list(), list(), list()
+        self.n_buffered_rows = 0
+
+    def isDone(self, entry_id, retry_failed = False):
+        """ Whether a file does not need to be extracted (again) """
+        entry_id = str(entry_id)
+        if entry_id in self.index["files"]:
+            return True
+        return not retry_failed and entry_id in self.index["failed"]
+
+    def add(self, entry_id, X, label):
+        X = np.asarray(X, dtype = self.dtype)
+        if X.ndim == 1:
+            X = X[np.newaxis, :]
+        self.buffer_X.append(X)
+        self.buffer_y.append(np.full(len(X), label, dtype = np.int32))
+        self.buffer_ids.append((str(entry_id), len(X)))
+        self.n_buffered_rows += len(X)
+        if self.n_buffered_rows >= self.shard_size:
+            self.flush()
+
+    def addFailure(self, entry_id, error):
+        self.index["failed"][str(entry_id)] = error
+
+    def flush(self):
+        """ Writes the buffered rows as a new shard and checkpoints the index """
+        if len(self.buffer_ids) > 0:
+            shard = len(self.index["shards"])
+            name = "shard_%05d" % shard
+            for prefix, arrays in [("X", self.buffer_X), ("y", self.buffer_y)]:
+                filepath = os.path.join(self.path, "%s_%s.npy" % (prefix, name))
+                with open(filepath + ".tmp", "wb") as f:
+                    np.save(f, np.concatenate(arrays))
+                os.replace(filepath + ".tmp", filepath)
+            start = 0
+            for entry_id, n_rows in self.buffer_ids:
+                self.index["files"][entry_id] = [shard, start, start + n_rows]
+                self.index["failed"].pop(entry_id, None)
+                start += n_rows
+            self.index["shards"].append({ "name" : name, "n_rows" : start })
+            self.buffer_X, self.buffer_y, self.buffer_ids = list(), list(), list()
+            self.n_buffered_rows = 0
+        saveIndex(self.path, self.index)
+
+    def build(self, entries, extractor, n_jobs = 1, retry_failed = False, verbose = True):
+        """ Extracts the features of all the entries that are not done yet.
+
+        Parameters
+        ----------
+        entries : list
+            (entry id, filename, label) tuples
+        extractor : callable
+            Picklable function mapping a filename to its feature matrix
+        n_jobs : int
+            Number of worker processes
+        retry_failed : bool
+            Whether the files that failed in a previous build are extracted
+            again (e.g. after a transient I/O error)
+        """
+        labels = { str(entry_id) : label for entry_id, _, label in entries }
+        pending = [(entry_id, filename) for entry_id, filename, _ in entries
+            if not self.isDone(entry_id, retry_failed = retry_failed)]
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            results = executor.map(extractEntry, [extractor] * len(pending),
+                *zip(*pending)) if len(pending) > 0 else list()
+            for entry_id, X, error in results:
+                if verbose:
+                    print("Processing file %s" % str(entry_id))
+                if error is None:
+                    self.add(entry_id, X, labels[str(entry_id)])
+                else:
+                    self.addFailure(entry_id, error)
+        self.flush()
+        return Dataset(self.path)
+
+def loadIndex(path):
+    filepath = os.path.join(path, "index.json")
+    if os.path.exists(filepath):
+        with open(filepath, "r") as f:
+            return json.load(f)
+    return { "shards" : list(), "files" : dict(), "failed" : dict() }
+
+def saveIndex(path, index):
+    filepath = os.path.join(path, "index.json")
+    with open(filepath + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(filepath + ".tmp", filepath)
+
+class Dataset:
+    """ Read-only view of a dataset built by DatasetBuilder.
+    Shards are memory-mapped, so nothing is loaded before it is accessed. """
+    def __init__(self, path):
+        self.path = path
+        self.index = loadIndex(path)
+        self.shards = [None] * len(self.index["shards"])
+
+    def __len__(self):
+        return len(self.index["files"])
+
+    def __contains__(self, entry_id):
+        return str(entry_id) in self.index["files"]
+
+    def getShard(self, shard):
+        if self.shards[shard] is None:
+            name = self.index["shards"][shard]["name"]
+            self.shards[shard] = tuple(
+                np.load(os.path.join(self.path, "%s_%s.npy" % (prefix, name)), mmap_mode = "r")
+                for prefix in ["X", "y"])
+        return self.shards[shard]
+
+    def getFile(self, entry_id):
+        """ Returns the memory-mapped features and labels of a single file """
+        shard, start, stop = self.index["files"][str(entry_id)]
+        X, y = self.getShard(shard)
+        return X[start:stop], y[start:stop]
+
+    def entryIds(self):
+        return list(self.index["files"].keys())
+
+    def iterFiles(self):
+        """ Lazily yields (entry id, features, labels) for every file """
+        for entry_id in self.entryIds():
+            X, y = self.getFile(entry_id)
+            yield entry_id, X, y
+
+    def iterShards(self):
+        """ Lazily yields the (features, labels) of every shard """
+        for shard in range(len(self.shards)):
+            yield self.getShard(shard)
+
+    def load(self, entry_ids = None):
+        """ Loads the rows of the given files (all files if None) in memory """
+        if entry_ids is None:
+            entry_ids = self.entryIds()
+        rows = [self.getFile(entry_id) for entry_id in entry_ids if entry_id in self]
+        if len(rows) == 0:
+            return np.empty((0, 0)), np.empty(0, dtype = np.int32)
+        return np.concatenate([X for X, _ in rows]), np.concatenate([y for _, y in rows])
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# index.py : On-disk chroma index of a music library
+# author : Antoine Passemiers
+
+import os, sys, json, argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import KEY_NAMES, KEY_DICT, isRelative, isOutByAFifth
+
+RELATION_SAME     = "same"
+RELATION_RELATIVE = "relative"
+RELATION_FIFTH    = "fifth"
+
+ALL_RELATIONS = (RELATION_SAME, RELATION_RELATIVE, RELATION_FIFTH)
+
+_compatibility_matrices = dict()
+
+def getCompatibilityMatrix(relations = ALL_RELATIONS):
+    """ Boolean matrix M such that M[i, j] is True if the keys i and j
+    are harmonically compatible under at least one of the relations """
+    relations = frozenset(relations)
+    if relations in _compatibility_matrices:
+        return _compatibility_matrices[relations]
+    mat = np.zeros((24, 24), dtype = bool)
+    for i, a in enumerate(KEY_NAMES):
+        for j, b in enumerate(KEY_NAMES):
+            mat[i, j] = (RELATION_SAME in relations and a == b) \
+                or (RELATION_RELATIVE in relations and isRelative(a, b)) \
+                or (RELATION_FIFTH in relations and isOutByAFifth(a, b))
+    _compatibility_matrices[relations] = mat
+    return mat
+
+class ChromaIndex:
+    """ Columnar index of a music library, stored in a directory.
+    Each column is a raw binary file that is memory-mapped for reading, and
+    that new tracks are appended to without rewriting the existing rows.
+    The number of committed rows is stored in meta.json, which is replaced
+    atomically after each append : rows written by an interrupted append
+    are ignored and overwritten by the next one.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the index, created if it does not exist
+
+    Attributes
+    ----------
+    hists : np.ndarray[ndim = 2]
+        Normalized 24-bin key histogram of each track
+    chromas : np.ndarray[ndim = 2]
+        Mean 12-bin chromatic vector of each track
+    keys : np.ndarray[ndim = 1]
+        Index of the predicted key of each track, in KEY_NAMES
+    """
+    COLUMNS = [
+        ("hists", np.float32, 24),
+        ("chromas", np.float32, 12),
+        ("keys", np.int8, 1) ]
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.n_tracks = 0
+        if os.path.exists(self.filepath("meta.json")):
+            with open(self.filepath("meta.json"), "r") as f:
+                self.n_tracks = json.load(f)["n_tracks"]
+        self.track_ids = list()
+        if self.n_tracks > 0:
+            """ No newline translation : the file holds one line feed per track id """
+            with open(self.filepath("ids.txt"), "r", encoding = "utf-8", newline = "\n") as f:
+                self.track_ids = f.read().split("\n")[:self.n_tracks]
+        self.rows = { track_id : row for row, track_id in enumerate(self.track_ids) }
+        self.reload()
+
+    def filepath(self, filename):
+        return os.path.join(self.path, filename)
+
+    def reload(self):
+        """ Memory-maps the committed rows of every column """
+        for name, dtype, width in ChromaIndex.COLUMNS:
+            shape = (self.n_tracks, width) if width > 1 else (self.n_tracks,)
+            if self.n_tracks > 0:
+                column = np.memmap(self.filepath(name + ".bin"), dtype = dtype, mode = "r", shape = shape)
+            else:
+                column = np.empty(shape, dtype = dtype)
+            setattr(self, name, column)
+        self.key_order, self.key_bounds = None, None
+
+    def __len__(self):
+        return self.n_tracks
+
+    def __contains__(self, track_id):
+        return track_id in self.rows
+
+    def extend(self, track_ids, hists, chromas, keys):
+        """ Appends new tracks to the index
+
+        Parameters
+        ----------
+        track_ids : list
+            Unique identifiers of the tracks (without line breaks)
+        hists : np.ndarray[ndim = 2]
+            Key histograms, of shape (n_tracks, 24)
+        chromas : np.ndarray[ndim = 2]
+            Mean chromatic vectors, of shape (n_tracks, 12)
+        keys : list
+            Predicted keys, either as names or as indexes in KEY_NAMES
+        """
+        track_ids = [str(track_id) for track_id in track_ids]
+        for track_id in track_ids:
+            if "\n" in track_id or track_id in self.rows:
+                raise ValueError("Invalid or duplicate track id: %s" % repr(track_id))
+        if len(set(track_ids)) != len(track_ids):
+            raise ValueError("Duplicate track ids in the same append")
+        hists = np.asarray(hists, dtype = np.double).reshape(len(track_ids), 24)
+        totals = hists.sum(axis = 1)[:, np.newaxis]
+        keys = [KEY_DICT[key] if isinstance(key, str) else key for key in keys]
+        values = {
+            "hists" : hists / np.where(totals > 0, totals, 1.0),
+            "chromas" : np.asarray(chromas).reshape(len(track_ids), 12),
+            "keys" : np.asarray(keys) }
+
+        for name, dtype, width in ChromaIndex.COLUMNS:
+            with open(self.filepath(name + ".bin"), "ab") as f:
+                f.truncate(self.n_tracks * width * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(values[name], dtype = dtype).tobytes())
+        with open(self.filepath("ids.txt"), "a", encoding = "utf-8", newline = "\n") as f:
+            f.truncate(sum(len(track_id.encode("utf-8")) + 1 for track_id in self.track_ids))
+            f.write("".join(track_id + "\n" for track_id in track_ids))
+
+        tmp_filepath = self.filepath("meta.json.tmp")
+        with open(tmp_filepath, "w") as f:
+            json.dump({ "n_tracks" : self.n_tracks + len(track_ids) }, f)
+        os.replace(tmp_filepath, self.filepath("meta.json"))
+
+        for track_id in track_ids:
+            self.rows[track_id] = len(self.track_ids)
+            self.track_ids.append(track_id)
+        self.n_tracks += len(track_ids)
+        self.reload()
+
+    def append(self, track_id, hist, chroma, key):
+        self.extend([track_id], [hist], [chroma], [key])
+
+    def lookup(self, track_id):
+        """ Returns the stored features of a single track """
+        row = self.rows[track_id]
+        return {
+            "row" : row,
+            "key" : KEY_NAMES[self.keys[row]],
+            "hist" : np.asarray(self.hists[row]),
+            "chroma" : np.asarray(self.chromas[row]) }
+
+    def tracksInKeys(self, key_indexes):
+        """ Returns the rows of all the tracks predicted in one of the given keys.
+        Rows are grouped by key once, so each query only gathers contiguous slices. """
+        if self.key_order is None:
+            self.key_order = np.argsort(self.keys, kind = "stable")
+            self.key_bounds = np.searchsorted(self.keys[self.key_order], np.arange(25))
+        slices = [self.key_order[self.key_bounds[k]:self.key_bounds[k+1]] for k in key_indexes]
+        return np.concatenate(slices) if len(slices) > 0 else np.empty(0, dtype = np.intp)
+
+    def compatibleWith(self, key, relations = ALL_RELATIONS):
+        """ Returns the rows of all the tracks harmonically compatible with a key,
+        given either as a key name or as the id of an indexed track """
+        if key not in KEY_DICT:
+            key = KEY_NAMES[self.keys[self.rows[key]]]
+        compatible = getCompatibilityMatrix(relations)[KEY_DICT[key]]
+        return self.tracksInKeys(np.where(compatible)[0])
+
+    def trackIds(self, rows):
+        return [self.track_ids[row] for row in rows]
+
+def extractIndexEntry(filename):
+    """ Analyses a file, returning its index entry or None on failure """
+    from cognitive import findKey, NO_FRAME_MESSAGE
+    try:
+        predicted_key, _, hist, extra = findKey(filename)
+        if predicted_key is None:
+            raise ValueError(NO_FRAME_MESSAGE)
+    except Exception as e:
+        sys.stderr.write("Skipping %s (%s: %s)\n" % (filename, type(e).__name__, str(e)))
+        return None
+    return filename, hist, extra.chromatic_matrix.mean(axis = 0), predicted_key
+
+def indexFiles(index, filenames, n_jobs = 1, chunk_size = 256):
+    """ Analyses files in parallel and appends them to the index by chunks.
+    Files that are already indexed are skipped. """
+    filenames = [filename for filename in filenames if filename not in index]
+    with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+        for start in range(0, len(filenames), chunk_size):
+            entries = executor.map(extractIndexEntry, filenames[start:start+chunk_size])
+            entries = [entry for entry in entries if entry is not None]
+            if len(entries) > 0:
+                index.extend(*zip(*entries))
+
+def main(argv = None):
+    from neuhon import iterInputFiles
+    parser = argparse.ArgumentParser(prog = "neuhon-index",
+        description = "Builds and queries a chroma index of a music library.")
+    parser.add_argument("index", help = "directory of the index")
+    subparsers = parser.add_subparsers(dest = "command")
+    add_parser = subparsers.add_parser("add", help = "analyse files and append them")
+    add_parser.add_argument("paths", nargs = "+", help = "wav files or directories")
+    add_parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1)
+    query_parser = subparsers.add_parser("compatible", help = "list compatible tracks")
+    query_parser.add_argument("key", help = "key name (e.g. Am) or track id")
+    query_parser.add_argument("-r", "--relations", nargs = "+", choices = ALL_RELATIONS,
+        default = list(ALL_RELATIONS))
+    args = parser.parse_args(argv)
+
+    index = ChromaIndex(args.index)
+    if args.command == "add":
+        indexFiles(index, list(iterInputFiles(args.paths)), n_jobs = args.jobs)
+        print("%d tracks indexed" % len(index))
+    elif args.command == "compatible":
+        for track_id in index.trackIds(index.compatibleWith(args.key, relations = args.relations)):
+            print(track_id)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
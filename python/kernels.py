@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# kernels.py : Optional compiled kernels for the per-sample loops
+# author : Antoine Passemiers
+
+import os
+import numpy as np
+from scipy.signal import lfilter as scipy_lfilter
+
+""" Numba is optional : without it (or with NEUHON_DISABLE_NUMBA=1),
+every function below falls back to its NumPy/SciPy implementation """
+try:
+    if os.environ.get("NEUHON_DISABLE_NUMBA", "0") != "0":
+        raise ImportError("Numba disabled by NEUHON_DISABLE_NUMBA")
+    import numba
+    HAS_NUMBA = True
+    prange = numba.prange
+    """ The TBB thread pool hangs the exit of a process that forked workers
+    after running a parallel kernel (the CLI, the server and the benchmarks
+    all fork process pools) : use the workqueue unless a layer is chosen
+    through NUMBA_THREADING_LAYER """
+    if "NUMBA_THREADING_LAYER" not in os.environ:
+        numba.config.THREADING_LAYER = "workqueue"
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+def jit(parallel = False):
+    """ Compiles a function in nopython mode when Numba is available,
+    and leaves it as a plain Python function otherwise """
+    def decorator(func):
+        if HAS_NUMBA:
+            return numba.njit(cache = True, parallel = parallel)(func)
+        return func
+    return decorator
+
+def useKernel(use_kernel):
+    """ The compiled loops are used by default only if Numba is available """
+    return HAS_NUMBA if use_kernel is None else use_kernel
+
+@jit()
+def lfilterLoop(b, a, x, zi):
+    """ Direct form II transposed IIR filter, with a[0] == 1 """
+    order = len(zi)
+    y = np.empty(len(x), dtype = np.float64)
+    z = zi.copy()
+    for i in range(len(x)):
+        xi = x[i]
+        yi = b[0] * xi + z[0]
+        for k in range(order - 1):
+            z[k] = b[k + 1] * xi + z[k + 1] - a[k + 1] * yi
+        z[order - 1] = b[order] * xi - a[order] * yi
+        y[i] = yi
+    return y, z
+
+def lfilter(b, a, x, zi = None, use_kernel = False):
+    """ Filters x with the IIR filter (b, a) and returns the filtered signal
+    together with the final filter state. Passing the final state of a block
+    as the initial state of the next one filters a stream block by block.
+    SciPy is used by default : the compiled loop is only faster on blocks
+    of a few dozen samples (see benchmarks.py kernels). """
+    n = max(len(a), len(b))
+    b = np.pad(np.asarray(b, dtype = np.float64), (0, n - len(b))) / a[0]
+    a = np.pad(np.asarray(a, dtype = np.float64), (0, n - len(a))) / a[0]
+    zi = np.zeros(n - 1, dtype = np.float64) if zi is None else np.asarray(zi, dtype = np.float64)
+    x = np.asarray(x, dtype = np.float64)
+    if n == 1:
+        return b[0] * x, zi
+    if useKernel(use_kernel):
+        return lfilterLoop(b, a, x, zi)
+    return scipy_lfilter(b, a, x, zi = zi)
+
+@jit(parallel = True)
+def goertzelLoop(frames, coefs):
+    n_frames, n_samples = frames.shape
+    power = np.empty((n_frames, len(coefs)), dtype = np.float64)
+    for f in prange(n_frames):
+        # The recurrences of the different bins are independent :
+        # updating them all at each sample lets the inner loop vectorize
+        s_prev = np.zeros(len(coefs), dtype = np.float64)
+        s_prev2 = np.zeros(len(coefs), dtype = np.float64)
+        for n in range(n_samples):
+            x = frames[f, n]
+            for k in range(len(coefs)):
+                s = x + coefs[k] * s_prev[k] - s_prev2[k]
+                s_prev2[k] = s_prev[k]
+                s_prev[k] = s
+        for k in range(len(coefs)):
+            power[f, k] = s_prev[k] ** 2 + s_prev2[k] ** 2 - coefs[k] * s_prev[k] * s_prev2[k]
+    return power
+
+def goertzelPower(frames, coefs, use_kernel = None):
+    """ Squared DFT magnitudes of every frame (rows) at the bins whose
+    Goertzel coefficients 2 * cos(omega) are given """
+    frames = np.ascontiguousarray(frames, dtype = np.float64)
+    coefs = np.asarray(coefs, dtype = np.float64)
+    if useKernel(use_kernel):
+        return goertzelLoop(frames, coefs)
+    s_prev = np.zeros((len(frames), len(coefs)), dtype = np.float64)
+    s_prev2 = np.zeros_like(s_prev)
+    for n in range(frames.shape[1]):
+        s = frames[:, n:n+1] + coefs * s_prev - s_prev2
+        s_prev2, s_prev = s_prev, s
+    return s_prev ** 2 + s_prev2 ** 2 - coefs * s_prev * s_prev2
+
+@jit(parallel = True)
+def zeroCrossingLoop(frames):
+    n_frames, n_samples = frames.shape
+    counts = np.zeros(n_frames, dtype = np.int64)
+    for f in prange(n_frames):
+        count = 0
+        for n in range(1, n_samples):
+            if (frames[f, n] < 0.0) != (frames[f, n - 1] < 0.0):
+                count += 1
+        counts[f] = count
+    return counts
+
+def zeroCrossingCounts(frames, use_kernel = None):
+    """ Number of sign changes within each frame (rows) """
+    frames = np.atleast_2d(frames)
+    if useKernel(use_kernel):
+        return zeroCrossingLoop(np.ascontiguousarray(frames, dtype = np.float64))
+    return np.count_nonzero(np.diff(frames < 0, axis = 1), axis = 1).astype(np.int64)
+
+@jit()
+def transitionCountLoop(observations, shift, counts):
+    for i in range(1, len(observations)):
+        x = (observations[i - 1] + 24 - shift) % 24
+        y = (observations[i] + 24 - shift) % 24
+        counts[x, y] += 1
+    return counts
+
+def transitionCounts(observations, shift, counts = None, use_kernel = None):
+    """ Adds the transitions between consecutive observations, with keys
+    rotated by shift (see markov.rotateKey), to a 24 x 24 count matrix """
+    if counts is None:
+        counts = np.zeros((24, 24), dtype = np.float64)
+    observations = np.asarray(observations, dtype = np.int64)
+    if useKernel(use_kernel):
+        return transitionCountLoop(observations, shift, counts)
+    rotated = (observations + 24 - shift) % 24
+    np.add.at(counts, (rotated[:-1], rotated[1:]), 1)
+    return counts
@@ -2,11 +2,12 @@
 # main.py
 # author : Antoine Passemiers
 
-import sys, pickle
+import sys, time, pickle
 
 from autocorrelation import *
 from cognitive import *
 from spectral import *
+from dataset import *
 
 from sklearn.tree import DecisionTreeClassifier
 
@@ -15,36 +16,54 @@ __all_detection_methods__ = [
     "findKeyUsingLombScargle",
     "findKeyUsingAutocorrelation"]
 
-def createTrainingSet():
-    dataset_X = list()
-    dataset_y = list()
-    csv_file = open(CSV_PATH, "r")
-    csv_file.readline()
-    for i in range(230): # 230
-        row = csv_file.readline().replace('\n', '').split(';')
-        artist, title, target_key, filename = row[0], row[1], row[2], row[3]
-        try:
-            _, _, vec, extra = findKeyUsingLombScargle(filename)
-            dataset_X.append(vec / float(np.sum(vec)))
-            dataset_y.append(KEY_DICT[target_key])
-        except IOError:
-            pass
-    np.save("dataset_X", np.array(dataset_X))
-    np.save("dataset_y", np.array(dataset_y))
+TRAINING_SET_PATH = "dataset_hist"
+
+def createTrainingSet(n_jobs = 4, retry_failed = False):
+    entries = loadEntries(CSV_PATH, 230) # 230
+    DatasetBuilder(TRAINING_SET_PATH).build(entries, extractKeyHistogram, n_jobs = n_jobs,
+        retry_failed = retry_failed)
 
 def fitModel():
-    dataset_X = np.load("dataset_X.npy")
-    dataset_y = np.load("dataset_y.npy")
+    dataset = Dataset(TRAINING_SET_PATH)
+    entry_ids = sorted(dataset.entryIds(), key = int)
 
     n = 150
-    train_X, validation_X = dataset_X[:n], dataset_X[n:]
-    train_y, validation_y = dataset_y[:n], dataset_y[n:]
+    train_X, train_y = dataset.load(entry_ids[:n])
+    validation_X, validation_y = dataset.load(entry_ids[n:])
 
     tree = DecisionTreeClassifier()
     tree.fit(train_X, train_y)
     predictions = tree.predict(validation_X)
     print(np.sum(predictions == validation_y), len(predictions))
 
+def evaluateCascade(method = METHOD_CQT, n_files = 480):
+    """ Compares the full analysis of every file with the coarse-to-fine
+    cascade : MIREX score, fraction of escalated files and speedup """
+    entries = loadEntries(CSV_PATH, n_files)
+    target_keys, full_keys, cascade_keys, escalated = list(), list(), list(), list()
+    full_time, cascade_time = 0.0, 0.0
+    for entry_id, filename, label in entries:
+        try:
+            signal = loadSignal(filename)
+        except IOError:
+            continue
+        start = time.time()
+        full_keys.append(findKeyInSignal(signal, method = method)[0])
+        full_time += time.time() - start
+        start = time.time()
+        predicted_key, _, _, extra = findKeyInSignal(signal, method = method, cascade = True)
+        cascade_time += time.time() - start
+        cascade_keys.append(predicted_key)
+        escalated.append(extra.escalated)
+        target_keys.append(KEY_NAMES[label])
+    print("Files : %d" % len(target_keys))
+    print("MIREX (full) : %f" % getMIREXScore(full_keys, target_keys))
+    print("MIREX (cascade) : %f" % getMIREXScore(cascade_keys, target_keys))
+    print("Escalated : %f" % np.mean(escalated))
+    print("Time (full) : %f s" % full_time)
+    print("Time (cascade) : %f s" % cascade_time)
+    print("Speedup : %f" % (full_time / max(cascade_time, 1e-9)))
+
 def main(prediction_func):
     csv_file = open(CSV_PATH, "r")
     csv_file.readline()
@@ -57,7 +76,7 @@ def main(prediction_func):
         artist, title, target_key, filename = row[0], row[1], row[2], row[3]
 
         try:
-            predicted_key, spectral_matrix, _, extra = prediction_func(filename)
+            predicted_key, spectral_matrix, _, extra = prediction_func(getDatasetPath(filename))
             chromatic_dataset.append((spectral_matrix, target_key))
             markov_dataset.append((extra.obs_seq, target_key))
             distance = getDistance(predicted_key, target_key)
@@ -89,4 +108,5 @@ if __name__ == "__main__":
     main(findKeyUsingCQT)
     # createTrainingSet()
     # fitModel()
+    # evaluateCascade()
     print("Finished")
\ No newline at end of file
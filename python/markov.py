@@ -4,8 +4,10 @@
 
 import numpy as np
 import pickle
+from scipy.special import logsumexp
 
 from utils import KEY_NAMES, KEY_DICT
+from kernels import transitionCounts
 
 def rotateKey(key, shift):
     return (key + 24 - shift) % 24
@@ -15,6 +17,8 @@ def predictKeyWithArgmax(obs):
     return KEY_NAMES[np.argmax(np.histogram(obs, np.arange(25))[0])]
 
 def predictKeyWithOneMatrix(obs, B):
+    if len(obs) == 0:
+        return None
     scores = np.zeros(24, dtype = np.double)
     for i in range(24):
         for t in range(1, len(obs)):
@@ -23,19 +27,163 @@ def predictKeyWithOneMatrix(obs, B):
             scores[i] += np.log2(B[x, y])
     return KEY_NAMES[scores.argmax()]
 
-if __name__ == "__main__":
-    B = np.zeros((24, 24), dtype = np.float)
-    dataset = pickle.load(open("markov_dataset.npy", "rb"))
-    for (observations, key) in dataset[:]:
-        for i in range(1, len(observations)):
-            k = KEY_DICT[key]
-            x = rotateKey(observations[i - 1], k)
-            y = rotateKey(observations[i], k)
-            B[x, y] += 1
+def fitTransitionMatrix(dataset):
+    """ Estimates the key-relative transition matrix from a list of
+    (observation sequence, key name) pairs """
+    B = np.zeros((24, 24), dtype = np.double)
+    for (observations, key) in dataset:
+        transitionCounts(observations, KEY_DICT[key], counts = B)
     for i in range(24):
         B[i, :] /= B[i, :].sum()
     for i in range(24):
         B[:, i] /= B[:, i].sum()
+    return B
+
+def getKeyTransitionMatrix(stay_probability = 0.99):
+    """ Transition matrix between the 24 key states, where a key is kept
+    from one frame to the next with the given probability and every
+    key change is equally likely """
+    A = np.full((24, 24), (1.0 - stay_probability) / 23.0, dtype = np.double)
+    np.fill_diagonal(A, stay_probability)
+    return A
+
+def getEmissionLogProbabilities(scores, sharpness = 5.0):
+    """ Turns per-frame correlation scores of shape (n_frames, 24),
+    as given by cognitive.getProfileScores, into log-probabilities of
+    the frames given each key state. Frames without scores (NaN rows,
+    e.g. silent frames) get uniform probabilities : they leave the
+    decoding to the neighbouring frames and the transitions. """
+    scores = sharpness * np.nan_to_num(np.asarray(scores, dtype = np.double))
+    return scores - logsumexp(scores, axis = -1)[..., np.newaxis]
+
+def padSequences(sequences):
+    """ Stacks sequences of shape (n_frames, 24) into an array of shape
+    (n_sequences, max_n_frames, 24) padded with zeros, and returns it
+    together with the sequence lengths """
+    lengths = np.asarray([len(seq) for seq in sequences], dtype = int)
+    padded = np.zeros((len(sequences), max(1, lengths.max(initial = 0)), 24), dtype = np.double)
+    for i, seq in enumerate(sequences):
+        padded[i, :len(seq)] = seq
+    return padded, lengths
+
+def viterbiBatch(log_emissions, log_transitions, log_initial = None):
+    """ Most likely key paths of several sequences at once.
+
+    Parameters
+    ----------
+    log_emissions : list
+        Log-probabilities of shape (n_frames, 24), one array per sequence
+    log_transitions : np.ndarray[ndim = 2]
+        Log-probabilities of going from key i (rows) to key j (columns)
+    log_initial : np.ndarray[ndim = 1]
+        Log-probabilities of the initial key (uniform if None)
+
+    Returns
+    -------
+    paths : list
+        Key index of each frame, one array per sequence
+    """
+    E, lengths = padSequences(log_emissions)
+    E = np.ascontiguousarray(E.transpose(1, 0, 2))
+    n_frames, n_sequences = E.shape[0], E.shape[1]
+    if log_initial is None:
+        log_initial = np.full(24, -np.log(24.0))
+    states = np.arange(24)
+    backpointers = np.empty((n_frames, n_sequences, 24), dtype = np.intp)
+    backpointers[0] = states
+    delta = log_initial + E[0]
+    for t in range(1, n_frames):
+        candidates = delta[:, :, np.newaxis] + log_transitions
+        backpointers[t] = candidates.argmax(axis = 1)
+        new_delta = candidates.max(axis = 1)
+        new_delta += E[t]
+        if t >= lengths.min():
+            active = (t < lengths)[:, np.newaxis]
+            new_delta = np.where(active, new_delta, delta)
+            backpointers[t] = np.where(active, backpointers[t], states)
+        delta = new_delta
+    path = np.empty((n_frames, n_sequences), dtype = np.intp)
+    path[-1] = delta.argmax(axis = 1)
+    sequences = np.arange(n_sequences)
+    for t in range(n_frames - 1, 0, -1):
+        path[t - 1] = backpointers[t, sequences, path[t]]
+    return [path[:length, i] for i, length in enumerate(lengths)]
+
+def forwardBackwardBatch(log_emissions, log_transitions, log_initial = None):
+    """ Posterior probabilities of the key states of several sequences at once.
+    Each log-sum-exp over the previous states is computed as a matrix product,
+    after factoring out the largest term.
+
+    Returns
+    -------
+    posteriors : list
+        Arrays of shape (n_frames, 24), one per sequence
+    log_likelihoods : np.ndarray[ndim = 1]
+        Log-likelihood of each sequence
+    """
+    E, lengths = padSequences(log_emissions)
+    E = np.ascontiguousarray(E.transpose(1, 0, 2))
+    n_frames = E.shape[0]
+    if log_initial is None:
+        log_initial = np.full(24, -np.log(24.0))
+    A = np.exp(log_transitions)
+    alpha = np.empty_like(E)
+    alpha[0] = log_initial + E[0]
+    for t in range(1, n_frames):
+        m = alpha[t - 1].max(axis = 1)[:, np.newaxis]
+        alpha[t] = np.log(np.dot(np.exp(alpha[t - 1] - m), A)) + m + E[t]
+        if t >= lengths.min():
+            alpha[t] = np.where((t < lengths)[:, np.newaxis], alpha[t], alpha[t - 1])
+    beta = np.zeros_like(E)
+    for t in range(n_frames - 2, -1, -1):
+        x = E[t + 1] + beta[t + 1]
+        m = x.max(axis = 1)[:, np.newaxis]
+        beta[t] = np.log(np.dot(np.exp(x - m), A.T)) + m
+        if t + 1 >= lengths.min():
+            beta[t] = np.where((t + 1 < lengths)[:, np.newaxis], beta[t], beta[t + 1])
+    log_likelihoods = logsumexp(alpha[-1], axis = 1)
+    posteriors = np.exp(alpha + beta - log_likelihoods[np.newaxis, :, np.newaxis])
+    return [posteriors[:length, i] for i, length in enumerate(lengths)], log_likelihoods
+
+def getKeySegments(path):
+    """ Splits a key path into (first frame, last frame + 1, key name) segments """
+    path = np.asarray(path)
+    if len(path) == 0:
+        return list()
+    starts = np.concatenate([[0], np.where(np.diff(path) != 0)[0] + 1])
+    ends = np.concatenate([starts[1:], [len(path)]])
+    return [(int(start), int(end), KEY_NAMES[path[start]]) for start, end in zip(starts, ends)]
+
+def decodeKeyPathBatch(scores, stay_probability = 0.99, sharpness = 5.0):
+    """ Decodes the key paths of several tracks from their per-frame profile
+    correlation scores. The global key of a track is the key state with the
+    highest total posterior probability.
+
+    Returns
+    -------
+    results : list
+        (global key name, key path, key segments) tuple of each track. A
+        track without any scored frame (no frame, or only silent frames)
+        has no key : its tuple is (None, empty path, empty list).
+    """
+    log_transitions = np.log(getKeyTransitionMatrix(stay_probability))
+    log_emissions = [getEmissionLogProbabilities(s, sharpness = sharpness) for s in scores]
+    paths = viterbiBatch(log_emissions, log_transitions)
+    posteriors, _ = forwardBackwardBatch(log_emissions, log_transitions)
+    results = list()
+    for s, path, posterior in zip(scores, paths, posteriors):
+        if not np.any(~np.isnan(np.asarray(s, dtype = np.double).reshape(-1, 24)).any(axis = 1)):
+            results.append((None, np.empty(0, dtype = np.intp), list()))
+        else:
+            results.append((KEY_NAMES[posterior.sum(axis = 0).argmax()], path, getKeySegments(path)))
+    return results
+
+def decodeKeyPath(scores, stay_probability = 0.99, sharpness = 5.0):
+    return decodeKeyPathBatch([scores], stay_probability, sharpness)[0]
+
+if __name__ == "__main__":
+    dataset = pickle.load(open("markov_dataset.npy", "rb"))
+    B = fitTransitionMatrix(dataset[:])
     print(B)
     tp = 0
     for (observations, key) in dataset[:]:
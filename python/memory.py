@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# memory.py : Memory accounting and budget-aware chunk sizing
+# author : Antoine Passemiers
+
+import tracemalloc, contextlib
+import numpy as np
+
+""" The resource module is Unix-only : without it, the peak RSS is unknown """
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from utils import Parameters
+
+MB = 1024.0 * 1024.0
+
+class MemoryTracker:
+    """ Peak memory of each stage of the analysis, as seen by tracemalloc
+    (NumPy reports its array buffers to it). The peak of a stage is the
+    largest amount of traced memory while it runs, including what was
+    allocated before it started : it is the working set of the stage.
+
+    Attributes
+    ----------
+    peaks : dict
+        Peak traced memory (in bytes) of each stage
+    """
+    def __init__(self):
+        self.peaks = dict()
+        self.stack = list()
+        self.started = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+        tracemalloc.reset_peak()
+
+    def stop(self):
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+    def collectPeak(self):
+        """ Credits the peak since the last reset to the running stages """
+        _, peak = tracemalloc.get_traced_memory()
+        for name in self.stack:
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+        tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.collectPeak()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.collectPeak()
+            self.stack.pop()
+
+    def getReport(self):
+        """ Peak of each stage, overall peak and peak resident set size of
+        the process, in megabytes """
+        self.collectPeak()
+        max_rss = getMaxRSS()
+        return {
+            "peak_mb" : max(self.peaks.values()) / MB if len(self.peaks) > 0 else 0.0,
+            "stages_mb" : { name : peak / MB for name, peak in self.peaks.items() },
+            "max_rss_mb" : None if max_rss is None else max_rss / MB }
+
+""" Tracker of the current process, if tracking is enabled """
+_tracker = None
+
+def startTracking():
+    global _tracker
+    _tracker = MemoryTracker()
+    _tracker.start()
+    return _tracker
+
+def stopTracking():
+    """ Stops tracking and returns the report of the tracker """
+    global _tracker
+    tracker, _tracker = _tracker, None
+    if tracker is None:
+        return None
+    report = tracker.getReport()
+    tracker.stop()
+    return report
+
+def trackStage(name):
+    """ Context manager recording the peak memory of a stage,
+    doing nothing if tracking is disabled """
+    if _tracker is None:
+        return contextlib.nullcontext()
+    return _tracker.stage(name)
+
+def getMaxRSS():
+    """ Peak resident set size of the process, in bytes (None if unknown) """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def getChunkSize(bytes_per_frame, n_frames, reserved = 0):
+    """ Number of frames a stage may process at once so that its working
+    memory stays within Parameters.memory_budget, given the memory already
+    reserved by the caller (signal, outputs). Without budget, all the
+    frames are processed at once. At least one frame is always processed. """
+    if Parameters.memory_budget is None:
+        return max(1, n_frames)
+    available = Parameters.memory_budget - reserved
+    return int(max(1, min(n_frames, available // max(1, bytes_per_frame))))
+
+def processInChunks(func, n_frames, n_coefs, bytes_per_frame, reserved = 0):
+    """ Fills a (n_frames, n_coefs) matrix by calling func on slices of
+    consecutive frames, with chunks sized by getChunkSize. The output
+    matrix counts as reserved memory. """
+    output = np.empty((n_frames, n_coefs), dtype = np.double)
+    chunk_size = getChunkSize(bytes_per_frame, n_frames, reserved = reserved + output.nbytes)
+    for chunk in iterChunks(n_frames, chunk_size):
+        output[chunk] = func(chunk)
+    return output
+
+def iterChunks(n_frames, chunk_size):
+    """ Slices of consecutive frames, chunk_size frames at a time """
+    for start in range(0, n_frames, chunk_size):
+        yield slice(start, min(n_frames, start + chunk_size))
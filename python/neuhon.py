@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# neuhon.py : Command-line batch key detector
+# author : Antoine Passemiers
+
+import os, sys, csv, json, time, queue, argparse, threading, collections
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils import KEY_DICT
+from cognitive import *
+from markov import predictKeyWithOneMatrix, decodeKeyPath
+from batch import analyseFileBatch
+from memory import startTracking, stopTracking
+
+SPECTRAL_METHODS = {
+    "cqt"          : METHOD_CQT,
+    "lomb-scargle" : METHOD_LOMB_SCARGLE,
+    "dft"          : METHOD_TARGETED_DFT,
+    "vanicek"      : METHOD_VANICEK }
+
+DECISION_HISTOGRAM = "histogram"
+DECISION_MARKOV    = "markov"
+DECISION_VITERBI   = "viterbi"
+
+CSV_FIELDS = ["file", "key", "confidence", "frames", "skipped", "escalated", "seconds", "error"]
+
+""" Per-process state, set by initWorker """
+_method = METHOD_CQT
+_decision = DECISION_HISTOGRAM
+_transition_matrix = None
+_cascade = False
+_gate = False
+_track_memory = False
+
+def initWorker(method, decision, transition_matrix, cascade = False, gate = False,
+        parameters = None, track_memory = False):
+    """ Sets the per-process state. parameters maps names of Parameters
+    fields to the values they take in this process. """
+    global _method, _decision, _transition_matrix, _cascade, _gate, _track_memory
+    _method = method
+    _decision = decision
+    _transition_matrix = transition_matrix
+    _cascade = cascade
+    _gate = gate
+    _track_memory = track_memory
+    for name, value in (parameters or dict()).items():
+        setattr(Parameters, name, value)
+
+def analyseFile(filename, signal = None):
+    """ Predicts the key of a single file and returns its result record.
+    Errors are reported in the record instead of being raised, so that
+    a single broken file never aborts a batch run. If signal is given,
+    it is used as the already loaded signal of the file. """
+    start = time.time()
+    if _track_memory:
+        startTracking()
+    record = analyseFileUntracked(filename, signal, start)
+    if _track_memory:
+        record["memory"] = stopTracking()
+    return record
+
+def analyseFileUntracked(filename, signal, start):
+    try:
+        if signal is None:
+            signal = loadSignal(filename)
+        predicted_key, _, hist, extra = findKeyInSignal(signal, method = _method,
+            cascade = _cascade, gate = _gate)
+        record = { "file" : filename }
+        segments = None
+        if _decision == DECISION_MARKOV:
+            predicted_key = predictKeyWithOneMatrix(extra.obs_seq, _transition_matrix)
+        elif _decision == DECISION_VITERBI:
+            scores = getProfileScores(
+                extra.chromatic_matrix, MAJOR_PROFILE_MATRIX, MINOR_PROFILE_MATRIX)
+            predicted_key, _, segments = decodeKeyPath(scores)
+        if predicted_key is None:
+            raise ValueError(NO_FRAME_MESSAGE)
+        n_frames = int(hist.sum())
+        record["key"] = predicted_key
+        record["confidence"] = float(hist[KEY_DICT[predicted_key]]) / n_frames if n_frames > 0 else 0.0
+        record["frames"] = n_frames
+        if _cascade:
+            record["escalated"] = extra.escalated
+        if extra.gate_mask is not None:
+            record["skipped"] = 1.0 - float(extra.gate_mask.mean()) if len(extra.gate_mask) > 0 else 0.0
+        if segments is not None:
+            """ Frame indexes -> seconds """
+            hop = float(2 * Parameters.slide if _method in (METHOD_LOMB_SCARGLE, METHOD_VANICEK) \
+                else Parameters.window_size)
+            hop /= Parameters.target_sampling_rate
+            record["segments"] = [(first * hop, last * hop, key) for first, last, key in segments]
+        record["seconds"] = time.time() - start
+        return record
+    except Exception as e:
+        return { "file" : filename, "error" : "%s: %s" % (type(e).__name__, str(e)),
+            "seconds" : time.time() - start }
+
+def analyseSingleFile(filename):
+    return [analyseFile(filename)]
+
+def analyseFileGroup(filenames):
+    """ Predicts the keys of several files whose frames are analysed in
+    shared batches (histogram decision only). The time of the group is
+    shared evenly between its records. """
+    start = time.time()
+    if _track_memory:
+        startTracking()
+    records = analyseFileBatch(filenames, method = _method, gate = _gate)
+    memory_report = stopTracking() if _track_memory else None
+    elapsed = time.time() - start
+    for record in records:
+        record["seconds"] = elapsed / len(records)
+        if memory_report is not None:
+            record["memory"] = memory_report
+    return records
+
+def iterGroups(filenames, group_size):
+    group = list()
+    for filename in filenames:
+        group.append(filename)
+        if len(group) == group_size:
+            yield group
+            group = list()
+    if len(group) > 0:
+        yield group
+
+def iterInputFiles(paths, manifest = None):
+    """ Expands files, directories (recursively, *.wav only) and
+    manifest lines into a flat sequence of file paths """
+    if manifest is not None:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    if filename.lower().endswith(".wav"):
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+class ResultWriter:
+    """ Streams one record per line, either as JSON or as CSV rows """
+    def __init__(self, stream, fmt = "json"):
+        self.stream = stream
+        self.fmt = fmt
+        if fmt == "csv":
+            self.writer = csv.DictWriter(stream, fieldnames = CSV_FIELDS, extrasaction = "ignore")
+            self.writer.writeheader()
+    def write(self, record):
+        if self.fmt == "csv":
+            self.writer.writerow(record)
+        else:
+            self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+def run(filenames, writer, method = METHOD_CQT, decision = DECISION_HISTOGRAM,
+        transition_matrix = None, n_jobs = 1, group_size = 1, cascade = False, gate = False,
+        parameters = None, track_memory = False):
+    """ Analyses all the files and writes their records as soon as they
+    are available. Returns the number of failed files. If group_size is
+    greater than 1, files are analysed by groups whose frames share the
+    same FFT and matrix product calls. If cascade is True, only the files
+    that a cheap first pass cannot decide are fully analysed. If gate is
+    True, silent and noisy frames are skipped (see cognitive.getFrameGate).
+    parameters overrides fields of Parameters in the workers. If track_memory
+    is True, each record gets the peak memory of its analysis and a summary
+    of the whole run goes to stderr. """
+    n_errors = 0
+    if group_size > 1:
+        func, tasks = analyseFileGroup, iterGroups(filenames, group_size)
+    else:
+        func, tasks = analyseSingleFile, filenames
+    initargs = (method, decision, transition_matrix, cascade, gate, parameters, track_memory)
+    if n_jobs == 1:
+        initWorker(*initargs)
+        results = (func(task) for task in tasks)
+    else:
+        results = iterPoolResults(func, tasks, n_jobs, initargs)
+    summary = MemorySummary()
+    for records in results:
+        for record in records:
+            n_errors += "error" in record
+            summary.add(record)
+            writer.write(record)
+    if track_memory:
+        sys.stderr.write(json.dumps(summary.getReport()) + "\n")
+    return n_errors
+
+def getTaskFiles(task):
+    """ Files of a task of run : a file name or a group of file names """
+    return [task] if isinstance(task, str) else list(task)
+
+def iterPoolResults(func, tasks, n_jobs, initargs, max_pending = None):
+    """ Yields func(task) for every task, computed by a pool of worker
+    processes, as soon as each one is done. Tasks are read and submitted by
+    a thread, at most max_pending (by default 2 * n_jobs) ahead, so that the
+    records of a streamed input are written while it is still being read.
+    A task that raises yields error records instead. When a worker dies
+    (e.g. killed when out of memory), the pool is replaced by a new one for
+    the next tasks, and the tasks it had in flight are run once more, one
+    at a time, each alone in a single-worker pool : only a task that kills
+    its worker again yields error records. """
+    max_pending = 2 * n_jobs if max_pending is None else max_pending
+    slots, finished = threading.Semaphore(max_pending), queue.Queue()
+    pools = [ProcessPoolExecutor(max_workers = n_jobs, initializer = initWorker, initargs = initargs)]
+    def submit(task):
+        try:
+            return pools[-1].submit(func, task)
+        except BrokenProcessPool:
+            pools.append(ProcessPoolExecutor(max_workers = n_jobs, initializer = initWorker, initargs = initargs))
+            return pools[-1].submit(func, task)
+    def feed():
+        n_submitted, error = 0, None
+        try:
+            for task in tasks:
+                slots.acquire()
+                submit(task).add_done_callback(lambda future, task = task: finished.put((future, task, False)))
+                n_submitted += 1
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, str(e))
+        finally:
+            finished.put((None, (n_submitted, error), False))
+    threading.Thread(target = feed, daemon = True).start()
+    n_submitted, n_done = None, 0
+    retries, retry_pool = collections.deque(), None
+    try:
+        while n_submitted is None or n_done < n_submitted:
+            future, task, retried = finished.get()
+            if future is None:
+                n_submitted, error = task
+                if error is not None:
+                    """ The input could not be read (e.g. a manifest read error) """
+                    yield [{ "file" : None, "error" : error, "seconds" : 0.0 }]
+                continue
+            if retried:
+                retry_pool.shutdown(wait = True)
+                retry_pool = None
+            results = None
+            if not retried and isinstance(future.exception(), BrokenProcessPool):
+                """ The task may only have been in flight when another task killed the worker """
+                retries.append(task)
+            else:
+                n_done += 1
+                slots.release()
+                try:
+                    results = future.result()
+                except Exception as e:
+                    error = "%s: %s" % (type(e).__name__, str(e))
+                    results = [{ "file" : filename, "error" : error, "seconds" : 0.0 }
+                        for filename in getTaskFiles(task)]
+            if retry_pool is None and len(retries) > 0:
+                retry_task = retries.popleft()
+                retry_pool = ProcessPoolExecutor(max_workers = 1, initializer = initWorker, initargs = initargs)
+                retry_pool.submit(func, retry_task).add_done_callback(
+                    lambda future, task = retry_task: finished.put((future, task, True)))
+            if results is not None:
+                yield results
+    finally:
+        for pool in pools + ([retry_pool] if retry_pool is not None else []):
+            pool.shutdown(wait = True, cancel_futures = True)
+
+class MemorySummary:
+    """ Largest peak memory numbers over the records of a run """
+    def __init__(self):
+        self.peaks = { "peak_mb" : 0.0, "max_rss_mb" : 0.0 }
+        self.stages = dict()
+    def add(self, record):
+        report = record.get("memory")
+        if report is not None:
+            for name in self.peaks:
+                if report[name] is not None:
+                    self.peaks[name] = max(self.peaks[name], report[name])
+            for name, peak in report["stages_mb"].items():
+                self.stages[name] = max(self.stages.get(name, 0.0), peak)
+    def getReport(self):
+        report = dict(self.peaks)
+        report["stages_mb"] = self.stages
+        return report
+
+def runPipeline(filenames, writer, n_readers = 2, prefetch = 8, **kwargs):
+    """ Same as run, with decoding overlapped with the analysis (see
+    pipeline.AnalysisPipeline). The stage utilisation goes to stderr. """
+    from pipeline import AnalysisPipeline
+    pipeline = AnalysisPipeline(n_readers = n_readers, prefetch = prefetch, **kwargs)
+    n_errors = 0
+    for record in pipeline.run(filenames):
+        n_errors += "error" in record
+        writer.write(record)
+    sys.stderr.write(json.dumps(pipeline.getReport()) + "\n")
+    return n_errors
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog = "neuhon",
+        description = "Predicts the musical key of wav files.")
+    parser.add_argument("paths", nargs = "*",
+        help = "wav files or directories; use '-' (or nothing) to read a manifest from stdin")
+    parser.add_argument("-m", "--method", choices = sorted(SPECTRAL_METHODS.keys()), default = "cqt",
+        help = "spectral density estimation method")
+    parser.add_argument("-d", "--decision", choices = [DECISION_HISTOGRAM, DECISION_MARKOV, DECISION_VITERBI],
+        default = DECISION_HISTOGRAM, help = "how local key predictions are combined")
+    parser.add_argument("-t", "--transitions",
+        help = ".npy transition matrix, as returned by markov.fitTransitionMatrix")
+    parser.add_argument("-f", "--format", choices = ["json", "csv"], default = "json",
+        help = "output format: one JSON object per line, or CSV rows")
+    parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1,
+        help = "number of worker processes")
+    parser.add_argument("-g", "--group", type = int, default = 1,
+        help = "number of files whose frames are analysed in shared batches "
+        "(histogram decision only); speeds up collections of short files")
+    parser.add_argument("-c", "--cascade", action = "store_true",
+        help = "predict from a cheap first pass and only run the full analysis "
+        "on ambiguous files (histogram decision only, see Parameters.cascade_*)")
+    parser.add_argument("--gate", action = "store_true",
+        help = "skip silent and noise-like frames before the spectral analysis "
+        "(see Parameters.gate_*)")
+    parser.add_argument("--memory-budget", type = float,
+        help = "working memory budget of each worker, in megabytes: frames are "
+        "analysed by chunks small enough to fit in it")
+    parser.add_argument("--memory-report", action = "store_true",
+        help = "report the peak memory of each stage in the records, "
+        "and a summary on stderr (slows the analysis down)")
+    parser.add_argument("-p", "--prefetch", type = int, default = 0,
+        help = "decode up to this many files ahead of the analysis, in threads that "
+        "overlap I/O with the worker processes (0 disables the pipeline)")
+    parser.add_argument("--readers", type = int, default = 2,
+        help = "number of decoder threads of the pipeline")
+    parser.add_argument("-o", "--output", help = "output file (defaults to stdout)")
+    args = parser.parse_args(argv)
+    if args.decision == DECISION_MARKOV and args.transitions is None:
+        parser.error("--decision markov requires --transitions")
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer")
+    if args.group < 1:
+        parser.error("--group must be a positive integer")
+    if args.group > 1 and args.decision != DECISION_HISTOGRAM:
+        parser.error("--group requires --decision histogram")
+    if args.cascade and (args.decision != DECISION_HISTOGRAM or args.group > 1):
+        parser.error("--cascade requires --decision histogram and cannot be combined with --group")
+    if args.gate and args.decision == DECISION_VITERBI:
+        parser.error("--gate cannot be combined with --decision viterbi")
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        parser.error("--memory-budget must be positive")
+    if args.prefetch < 0 or args.readers < 1:
+        parser.error("--prefetch must be non-negative and --readers positive")
+    if args.prefetch > 0 and args.group > 1:
+        parser.error("--prefetch and --group cannot be combined")
+    return args
+
+def main(argv = None):
+    args = parseArguments(argv)
+    paths = [path for path in args.paths if path != "-"]
+    manifest = sys.stdin if len(paths) < len(args.paths) or not args.paths else None
+    transition_matrix = np.load(args.transitions) if args.transitions else None
+
+    output = open(args.output, "w", newline = "") if args.output else sys.stdout
+    parameters = dict()
+    if args.memory_budget is not None:
+        parameters["memory_budget"] = int(args.memory_budget * 1024 * 1024)
+    options = dict(method = SPECTRAL_METHODS[args.method], decision = args.decision,
+        transition_matrix = transition_matrix, n_jobs = args.jobs, cascade = args.cascade,
+        gate = args.gate, parameters = parameters, track_memory = args.memory_report)
+    try:
+        if args.prefetch > 0:
+            n_errors = runPipeline(iterInputFiles(paths, manifest), ResultWriter(output, args.format),
+                n_readers = args.readers, prefetch = args.prefetch, **options)
+        else:
+            n_errors = run(iterInputFiles(paths, manifest), ResultWriter(output, args.format),
+                group_size = args.group, **options)
+    finally:
+        if args.output:
+            output.close()
+    return 1 if n_errors > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
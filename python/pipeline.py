@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# pipeline.py : Overlapped decoding and analysis of many wav files
+# author : Antoine Passemiers
+
+import time, queue, threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from cognitive import *
+import neuhon
+
+class SignalRing:
+    """ Fixed number of slots in shared memory, each holding one decimated
+    signal. Decoder threads write signals into free slots and analysis
+    processes read them in place, so no large array is ever pickled.
+
+    Parameters
+    ----------
+    n_slots : int
+        Number of signals that can be in flight at the same time
+    slot_size : int
+        Maximum number of samples of a signal
+    name : str
+        Name of an existing ring to attach to, or None to create one
+    """
+    def __init__(self, n_slots, slot_size, name = None):
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name = name, create = self.owner,
+            size = max(1, n_slots * slot_size * np.dtype(np.double).itemsize))
+        self.slots = np.ndarray((n_slots, slot_size), dtype = np.double, buffer = self.shm.buf)
+        self.free = queue.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+
+    def acquire(self):
+        """ Blocks until a slot is free """
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def close(self):
+        self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+""" Per-process state of the analysis workers, set by initPipelineWorker """
+_ring = None
+
+def initPipelineWorker(name, n_slots, slot_size, method, decision, transition_matrix,
+        cascade, gate, parameters, track_memory):
+    global _ring
+    neuhon.initWorker(method, decision, transition_matrix, cascade, gate, parameters, track_memory)
+    _ring = SignalRing(n_slots, slot_size, name = name)
+
+def analyseSlot(slot, length, filename):
+    """ Analyses the signal stored in a slot of the ring. Returns the result
+    record and the time spent in this worker. """
+    start = time.time()
+    record = neuhon.analyseFile(filename, signal = _ring.slots[slot, :length])
+    return record, time.time() - start
+
+def analyseOversized(filename, signal):
+    start = time.time()
+    record = neuhon.analyseFile(filename, signal = signal)
+    return record, time.time() - start
+
+_DONE = object()
+
+class AnalysisPipeline:
+    """ Staged key detection of many files : decoder threads prefetch and
+    decode the next files (reading releases the GIL) while a pool of
+    processes analyses the signals already decoded.
+
+    Queues are bounded, so a slow stage stalls the stages before it instead
+    of letting decoded signals pile up in memory : at most prefetch file
+    names are waiting for a decoder, and decoders wait for a free slot of
+    the ring before decoding the next file.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of analysis processes
+    n_readers : int
+        Number of decoder threads
+    prefetch : int
+        Number of file names queued ahead of the decoders
+    n_slots : int
+        Number of ring slots (decoded signals in flight), defaults to 2 * n_jobs
+    max_duration : float
+        Duration (in seconds) of a ring slot. Longer signals are sent to the
+        workers by pickling instead.
+    cascade : bool
+        Whether the workers use the coarse-to-fine cascade (see cognitive.findKeyByCascade)
+    gate : bool
+        Whether the workers skip silent and noisy frames (see cognitive.getFrameGate)
+    parameters : dict
+        Values of Parameters fields in the workers (e.g. memory_budget)
+    track_memory : bool
+        Whether the workers report the peak memory of each file
+
+    Attributes
+    ----------
+    stats : dict
+        Counters and busy times of the last run, see getReport
+    """
+    def __init__(self, method = METHOD_CQT, decision = neuhon.DECISION_HISTOGRAM,
+            transition_matrix = None, n_jobs = 1, n_readers = 2, prefetch = 8,
+            n_slots = None, max_duration = 600.0, cascade = False, gate = False,
+            parameters = None, track_memory = False):
+        self.method = method
+        self.decision = decision
+        self.transition_matrix = transition_matrix
+        self.cascade = cascade
+        self.gate = gate
+        self.parameters = parameters
+        self.track_memory = track_memory
+        self.memory_summary = neuhon.MemorySummary()
+        self.n_jobs = n_jobs
+        self.n_readers = n_readers
+        self.prefetch = prefetch
+        self.n_slots = 2 * n_jobs if n_slots is None else n_slots
+        self.slot_size = int(max_duration * Parameters.target_sampling_rate)
+        self.lock = threading.Lock()
+        self.stats = dict()
+
+    def addStat(self, name, value):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def feed(self, filenames, inputs, results):
+        """ Queues the file names. If reading them fails (e.g. a manifest
+        read error), the error is reported as a record and the decoders are
+        still told to stop, so that the run ends. """
+        try:
+            for filename in filenames:
+                inputs.put(filename)
+        except Exception as e:
+            results.put({ "file" : None, "error" : "%s: %s" % (type(e).__name__, str(e)) })
+        finally:
+            for _ in range(self.n_readers):
+                inputs.put(None)
+
+    def decode(self, ring, inputs, ready):
+        while True:
+            filename = inputs.get()
+            if filename is None:
+                ready.put(None)
+                return
+            start = time.time()
+            try:
+                signal = loadSignal(filename)
+            except Exception as e:
+                self.addStat("decode_busy", time.time() - start)
+                ready.put(("error", { "file" : filename,
+                    "error" : "%s: %s" % (type(e).__name__, str(e)), "seconds" : 0.0 }))
+                continue
+            self.addStat("decode_busy", time.time() - start)
+            if len(signal) > ring.slot_size:
+                ready.put(("oversized", filename, signal))
+                continue
+            start = time.time()
+            slot = ring.acquire()
+            self.addStat("decode_blocked", time.time() - start)
+            ring.slots[slot, :len(signal)] = signal
+            ready.put(("slot", slot, len(signal), filename))
+
+    def createExecutor(self, ring):
+        return ProcessPoolExecutor(max_workers = self.n_jobs, initializer = initPipelineWorker,
+            initargs = (ring.shm.name, ring.n_slots, ring.slot_size,
+            self.method, self.decision, self.transition_matrix, self.cascade, self.gate,
+            self.parameters, self.track_memory))
+
+    def dispatch(self, ring, pools, ready, results):
+        """ Submits the decoded signals to the analysis processes. A pool
+        broken by a dead worker is replaced by a new one (appended to pools)
+        for the next signals. A signal that cannot be submitted gets an error
+        record and its slot back. """
+        def onDone(future, filename, slot = None):
+            if slot is not None:
+                ring.release(slot)
+            try:
+                record, busy = future.result()
+            except Exception as e:
+                record, busy = { "file" : filename,
+                    "error" : "%s: %s" % (type(e).__name__, str(e)) }, 0.0
+            self.addStat("analysis_busy", busy)
+            results.put(record)
+        def submit(func, *args):
+            try:
+                return pools[-1].submit(func, *args)
+            except BrokenProcessPool:
+                pools.append(self.createExecutor(ring))
+                return pools[-1].submit(func, *args)
+        n_finished, futures = 0, list()
+        try:
+            while n_finished < self.n_readers:
+                item = ready.get()
+                if item is None:
+                    n_finished += 1
+                    continue
+                elif item[0] == "error":
+                    results.put(item[1])
+                    continue
+                elif item[0] == "oversized":
+                    self.addStat("oversized", 1)
+                    _, filename, signal = item
+                    slot, func, args = None, analyseOversized, (filename, signal)
+                else:
+                    _, slot, length, filename = item
+                    func, args = analyseSlot, (slot, length, filename)
+                try:
+                    future = submit(func, *args)
+                except Exception as e:
+                    if slot is not None:
+                        ring.release(slot)
+                    results.put({ "file" : filename,
+                        "error" : "%s: %s" % (type(e).__name__, str(e)), "seconds" : 0.0 })
+                    continue
+                future.add_done_callback(lambda f, filename = filename, slot = slot: onDone(f, filename, slot))
+                futures.append(future)
+            for future in futures:
+                future.exception()
+        except Exception as e:
+            results.put({ "file" : None, "error" : "%s: %s" % (type(e).__name__, str(e)) })
+        finally:
+            results.put(_DONE)
+
+    def run(self, filenames):
+        """ Yields the result record of every file as soon as it is available """
+        self.stats = { "files" : 0, "errors" : 0, "oversized" : 0,
+            "decode_busy" : 0.0, "decode_blocked" : 0.0, "analysis_busy" : 0.0 }
+        self.memory_summary = neuhon.MemorySummary()
+        start = time.time()
+        ring = SignalRing(self.n_slots, self.slot_size)
+        inputs = queue.Queue(maxsize = self.prefetch)
+        ready = queue.Queue(maxsize = self.n_slots)
+        results = queue.Queue()
+        pools = [self.createExecutor(ring)]
+        threads = [threading.Thread(target = self.feed, args = (filenames, inputs, results))]
+        threads += [threading.Thread(target = self.decode, args = (ring, inputs, ready))
+            for _ in range(self.n_readers)]
+        threads.append(threading.Thread(target = self.dispatch, args = (ring, pools, ready, results)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                record = results.get()
+                if record is _DONE:
+                    break
+                self.stats["files"] += 1
+                self.stats["errors"] += "error" in record
+                self.memory_summary.add(record)
+                yield record
+        finally:
+            for pool in pools:
+                pool.shutdown(wait = True, cancel_futures = True)
+            ring.close()
+            self.stats["seconds"] = time.time() - start
+
+    def getReport(self):
+        """ Wall-clock time, counters and the utilisation of each stage, i.e.
+        its busy time divided by the time available to its threads/processes.
+        The memory of the ring is allocated once, in shared memory, and the
+        peaks of the workers are only known if they track their memory. """
+        wall = max(self.stats.get("seconds", 0.0), 1e-9)
+        report = { name : self.stats.get(name, 0) for name in ["files", "errors", "oversized", "seconds"] }
+        report["utilisation"] = {
+            "decode" : self.stats.get("decode_busy", 0.0) / (wall * self.n_readers),
+            "decode_blocked" : self.stats.get("decode_blocked", 0.0) / (wall * self.n_readers),
+            "analysis" : self.stats.get("analysis_busy", 0.0) / (wall * self.n_jobs) }
+        report["ring_mb"] = self.n_slots * self.slot_size * np.dtype(np.double).itemsize / (1024.0 * 1024.0)
+        if self.track_memory:
+            report["memory"] = self.memory_summary.getReport()
+        return report
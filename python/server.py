@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# server.py : Long-running key detection service
+# author : Antoine Passemiers
+
+import io, os, sys, json, time, asyncio, argparse, collections
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from scipy.io.wavfile import read as scipy_read
+
+from cognitive import *
+from batch import analyseSignalBatch
+from neuhon import SPECTRAL_METHODS
+
+def warmUpWorker():
+    """ Builds every kernel and runs a dummy batch through each method, so that
+    neither imports, kernels nor BLAS initialization are paid by a request """
+    signal = np.random.RandomState(0).randn(4 * Parameters.window_size)
+    for method in SPECTRAL_METHODS.values():
+        analyseSignalBatch([signal], method)
+
+def noop():
+    pass
+
+def decodeWav(data):
+    """ Decodes wav file contents into a mono, downsampled signal """
+    framerate, signal = scipy_read(io.BytesIO(data))
+    if framerate != Parameters.sampling_rate:
+        raise ValueError("Unsupported sampling rate: %d Hz" % framerate)
+    signal = stereoToMono(signal)
+    return downSampling(signal, framerate = Parameters.target_sampling_rate)
+
+class FrameBatcher:
+    """ Groups the signals of concurrent requests into micro-batches.
+
+    A batch is sent to the process pool either when it holds at least
+    max_batch_frames frames, or batch_window seconds after its first signal
+    arrived, whichever comes first.
+    """
+    def __init__(self, executor, method, batch_window, max_batch_frames):
+        self.executor = executor
+        self.method = method
+        self.batch_window = batch_window
+        self.max_batch_frames = max_batch_frames
+        self.pending = list()
+        self.n_pending_frames = 0
+        self.n_running = 0
+        self.n_batches = 0
+        self.n_batched_signals = 0
+        self.timer = None
+        """ The event loop only keeps weak references to tasks """
+        self.tasks = set()
+
+    def submit(self, signal):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((signal, future))
+        self.n_pending_frames += len(signal) // Parameters.window_size
+        if self.n_pending_frames >= self.max_batch_frames:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.batch_window, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending, self.n_pending_frames = self.pending, list(), 0
+        if len(batch) > 0:
+            task = asyncio.ensure_future(self.run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch):
+        loop = asyncio.get_running_loop()
+        self.n_running += 1
+        self.n_batches += 1
+        self.n_batched_signals += len(batch)
+        try:
+            results = await loop.run_in_executor(self.executor,
+                analyseSignalBatch, [signal for signal, _ in batch], self.method)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.n_running -= 1
+
+class KeyServer:
+    """ Key detection service answering HTTP requests, either on a TCP port
+    or on a Unix socket.
+
+    Endpoints
+    ---------
+    POST /key?method=cqt
+        Predicts the key of the wav file sent as request body
+    POST /key?method=cqt&file=path
+        Predicts the key of a wav file readable by the server
+    GET /stats
+        Queue depth, batching counters and latency percentiles
+    """
+    def __init__(self, n_jobs = 1, batch_window = 0.005, max_batch_frames = 2048, history = 1000):
+        self.n_jobs = n_jobs
+        self.executor = ProcessPoolExecutor(max_workers = n_jobs, initializer = warmUpWorker)
+        self.batchers = { method : FrameBatcher(self.executor, method, batch_window, max_batch_frames)
+            for method in SPECTRAL_METHODS.values() }
+        self.latencies = collections.deque(maxlen = history)
+        self.n_in_flight = 0
+        self.n_completed = 0
+        self.n_errors = 0
+
+    async def start(self):
+        """ Starts the worker processes and waits until they are warm """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, noop)
+            for _ in range(self.n_jobs)])
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+
+    async def predict(self, method, data = None, filename = None):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        self.n_in_flight += 1
+        try:
+            if filename is not None:
+                signal = await loop.run_in_executor(self.executor, loadSignal, filename)
+            else:
+                signal = await loop.run_in_executor(self.executor, decodeWav, data)
+            result = await self.batchers[method].submit(signal)
+            if "error" in result:
+                self.n_errors += 1
+            else:
+                self.n_completed += 1
+        except Exception:
+            self.n_errors += 1
+            raise
+        finally:
+            self.n_in_flight -= 1
+            self.latencies.append(time.time() - start)
+        result["seconds"] = time.time() - start
+        return result
+
+    def getStats(self):
+        stats = {
+            "queue_depth" : self.n_in_flight,
+            "pending_signals" : sum(len(b.pending) for b in self.batchers.values()),
+            "running_batches" : sum(b.n_running for b in self.batchers.values()),
+            "completed" : self.n_completed,
+            "errors" : self.n_errors,
+            "batches" : sum(b.n_batches for b in self.batchers.values()),
+            "batched_signals" : sum(b.n_batched_signals for b in self.batchers.values()) }
+        if len(self.latencies) > 0:
+            percentiles = np.percentile(np.asarray(self.latencies) * 1000.0, [50, 90, 99])
+            stats["latency_ms"] = dict(zip(["p50", "p90", "p99"], percentiles.tolist()))
+        return stats
+
+    async def route(self, verb, target, body):
+        url = urlsplit(target)
+        query = { name : values[-1] for name, values in parse_qs(url.query).items() }
+        if url.path == "/stats" and verb == "GET":
+            return 200, self.getStats()
+        elif url.path == "/key" and verb == "POST":
+            method_name = query.get("method", "cqt")
+            if method_name not in SPECTRAL_METHODS:
+                return 400, { "error" : "Unknown method: %s" % method_name }
+            try:
+                result = await self.predict(SPECTRAL_METHODS[method_name],
+                    data = body, filename = query.get("file"))
+                return (422 if "error" in result else 200), result
+            except Exception as e:
+                return 422, { "error" : "%s: %s" % (type(e).__name__, str(e)) }
+        return 404, { "error" : "Not found: %s %s" % (verb, url.path) }
+
+    async def handleConnection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1")
+            verb, target, _ = request_line.split(" ", 2)
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self.route(verb, target, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, { "error" : "Bad request: %s" % str(e) }
+        content = json.dumps(payload).encode("utf-8")
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+            "Content-Length: %d\r\nConnection: close\r\n\r\n" % (
+            status, HTTP_REASONS.get(status, ""), len(content))).encode("latin-1") + content)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host = "127.0.0.1", port = 8470, path = None):
+        """ Serves forever, on a Unix socket if path is given """
+        await self.start()
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handleConnection, path = path)
+        else:
+            server = await asyncio.start_server(self.handleConnection, host = host, port = port)
+        async with server:
+            await server.serve_forever()
+
+HTTP_REASONS = { 200 : "OK", 400 : "Bad Request", 404 : "Not Found", 422 : "Unprocessable Entity" }
+
+async def fetch(verb, target, body = b"", host = "127.0.0.1", port = 8470, path = None):
+    """ Minimal client, returns the HTTP status and the decoded JSON payload """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    writer.write(("%s %s HTTP/1.1\r\nHost: neuhon\r\nContent-Length: %d\r\n\r\n" % (
+        verb, target, len(body))).encode("latin-1") + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), json.loads(content.decode("utf-8"))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "neuhon-server",
+        description = "Serves key predictions over HTTP.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8470)
+    parser.add_argument("--unix", help = "listen on this Unix socket instead of TCP")
+    parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1,
+        help = "number of worker processes")
+    parser.add_argument("--batch-window", type = float, default = 0.005,
+        help = "maximum time (in seconds) a request waits for its batch to fill")
+    parser.add_argument("--max-batch-frames", type = int, default = 2048,
+        help = "number of frames above which a batch is sent immediately")
+    args = parser.parse_args(argv)
+    server = KeyServer(n_jobs = args.jobs, batch_window = args.batch_window,
+        max_batch_frames = args.max_batch_frames)
+    try:
+        asyncio.run(server.serve(host = args.host, port = args.port, path = args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
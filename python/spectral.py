@@ -4,18 +4,32 @@
 
 import numpy as np
 import random
+from scipy.fft import next_fast_len
+from scipy.linalg import cho_factor, cho_solve
 
 from utils import Parameters
+from kernels import goertzelPower
+from memory import processInChunks
 
 
 class VanicekRegressor:
 	""" Least squares regressor for fitting samples with their corresponding
 	spectrum by infering the spectral coefficients. This implementation is based
-	on the Vaníček method. The spectral coefficients are given by :
-	x = inv(A.T * A) * A.T * psi,
-	where psi is the input samples vector,
-	A is a matrix containing known sinusoidal samples,
-	and x is the pseudo-spectrum.
+	on the Vaníček method. The samples psi are modelled as a sum of a cosine
+	and a sine at each note frequency, whose coefficients are given by :
+	x = inv(A * A.T) * A * psi,
+	where A is a matrix whose rows are the known sinusoidal samples,
+	and the pseudo-spectrum is the power of each cosine/sine pair.
+	A * A.T is only (2 * n_notes) x (2 * n_notes) : its Cholesky factorization
+	is computed once per configuration and shared by all the regressors.
+
+	The sinusoids can only be told apart if the window holds enough periods
+	of the lowest note (about 10) : at 4410 Hz, window_size must be at least
+	4096 with the default notes (8-80), 2048 from min_midi_note = 20 and 1024
+	from min_midi_note = 32. Below that, A * A.T is singular (its condition
+	number goes from about 40 to more than 1e14) : the automatic ridge keeps
+	the factorization stable, but the power of the lowest notes leaks into
+	their neighbours.
 
 	Parameters
 	----------
@@ -23,42 +37,66 @@ class VanicekRegressor:
 	    Number of input samples per window
 	sampling_rate : float
 	    Sampling rate of the input samples
+	regularization : float
+	    Ridge term added to the diagonal of A * A.T, relative to its mean.
+	    If None, the smallest ridge bringing the condition number of
+	    A * A.T down to MAX_CONDITION is used (none for supported windows).
 
 	Attributes
 	----------
 	A : np.ndarray[ndim = 2]
-	    Matrix where each row is a sinusoide of given frequency
-	LRPM : np.ndarray[ndim = 2]
-	    LRPM := inv(A.T * A) * A.T
-
+	    Matrix where each row is a sinusoide of given frequency,
+	    cosines first and then sines
+	factor : tuple
+	    Cholesky factorization of A * A.T, as returned by scipy's cho_factor
 	"""
-	def __init__(self, window_size, sampling_rate):
+	_cache = dict()
+
+	MAX_CONDITION = 1e8
+
+	def __init__(self, window_size, sampling_rate, regularization = None):
 		""" Precomputes what can be precomputed for the linear regression """
 		self.window_size = window_size
 		self.sampling_rate = sampling_rate
-		self.A, self.phases = self.matrixOfSinusoidals(window_size, sampling_rate)
-		self.LRPM = self.linearRegressionPreprocessing(self.A).T
+		config = (window_size, sampling_rate, regularization, tuple(Parameters.note_frequencies))
+		if config not in VanicekRegressor._cache:
+			A = self.matrixOfSinusoidals(window_size, sampling_rate)
+			VanicekRegressor._cache[config] = (A, self.linearRegressionPreprocessing(A, regularization))
+		self.A, self.factor = VanicekRegressor._cache[config]
 
 	def matrixOfSinusoidals(self, window_size, sampling_rate):
-		""" Precomputes the matrix A with random phase changes.
-		Indeed, if every sinusoide is provided with no phase change,
-		the resulting matrix A tends to be singular. """
-		time = np.arange(window_size)
-		A = np.empty((len(Parameters.note_frequencies), window_size), dtype = np.double)
-		phases = np.empty(len(Parameters.note_frequencies), dtype = np.double)
-		for i, freq in enumerate(Parameters.note_frequencies):
-			phases[i] = 2.0 * np.pi * np.random.rand(1)[0]
-			sine_wave = np.sin(2.0 * np.pi * time * (freq / sampling_rate) + phases[i])
-			A[i, :] = sine_wave[:]
-		return A, phases
+		""" Precomputes the matrix A """
+		tmp = 2.0 * np.pi * np.outer(Parameters.note_frequencies / sampling_rate, np.arange(window_size))
+		return np.concatenate((np.cos(tmp), np.sin(tmp)), axis = 0)
+
+	def linearRegressionPreprocessing(self, A, regularization):
+		""" Factorizes the normal equations matrix A * A.T """
+		gram = np.dot(A, A.T)
+		if regularization is None:
+			""" Adding r to the diagonal shifts all the eigenvalues by r : the smallest
+			r such that (max + r) / (min + r) <= MAX_CONDITION """
+			eigenvalues = np.linalg.eigvalsh(gram)
+			c = VanicekRegressor.MAX_CONDITION
+			ridge = max(0.0, (eigenvalues[-1] - c * eigenvalues[0]) / (c - 1.0))
+		else:
+			ridge = regularization * np.trace(gram) / len(gram)
+		gram[np.diag_indices_from(gram)] += ridge
+		return cho_factor(gram)
 
-	def linearRegressionPreprocessing(self, A):
-		""" Precomputes the matrix LRPM """
-		return np.dot(np.linalg.inv(np.dot(A.T, A)), A.T)
+	def fitMatrix(self, frames, chunk_size = 256):
+		""" Computes the pseudo-spectra of all the rows of frames, solving the
+		normal equations for chunk_size frames at a time """
+		frames = np.atleast_2d(frames)[:, :self.window_size]
+		n_notes = len(self.A) // 2
+		spectra = np.empty((len(frames), n_notes), dtype = np.double)
+		for start in range(0, len(frames), chunk_size):
+			x = cho_solve(self.factor, np.dot(self.A, frames[start:start+chunk_size].T))
+			spectra[start:start+chunk_size] = (x[:n_notes] ** 2 + x[n_notes:] ** 2).T
+		return spectra
 
 	def fit(self, psi):
-		""" Computes x = LRPM * psi """
-		return np.dot(self.LRPM, psi)
+		""" Computes the pseudo-spectrum of a single window """
+		return self.fitMatrix(psi)[0]
 
 
 class LombScargleRegressor:
@@ -115,6 +153,197 @@ class LombScargleRegressor:
 			Px[i] = 0.5 * (num_a / self.dens_a[i] + num_b / self.dens_b[i])
 		return Px
 
+	def fitMatrix(self, frames):
+		""" Computes the periodograms of all the rows of frames at once """
+		frames = frames[:, :self.window_size]
+		num_a = np.dot(frames, np.asarray(self.cos_waves).T) ** 2
+		num_b = np.dot(frames, np.asarray(self.sin_waves).T) ** 2
+		return 0.5 * (num_a / np.asarray(self.dens_a) + num_b / np.asarray(self.dens_b))
+
+def lagrangeWeights(x, order):
+	""" Nodes and weights of the Lagrange interpolation at each point of x
+	from its order nearest integers. Spreading a value over the same nodes
+	with the same weights is the extirpolation of Press and Rybicki. """
+	x = np.asarray(x, dtype = np.double)
+	nodes = np.floor(x).astype(int)[:, np.newaxis] - (order - 1) // 2 + np.arange(order)
+	weights = np.ones((len(x), order), dtype = np.double)
+	for m in range(order):
+		for l in range(order):
+			if l != m:
+				weights[:, m] *= (x - nodes[:, l]) / float(m - l)
+	return nodes, weights
+
+class FastLombScargleRegressor:
+	""" Lomb-Scargle periodogram computed with the method of Press and Rybicki,
+	for samples taken at arbitrary times (e.g. frames with masked samples,
+	or beat-aligned sampling).
+
+	The samples are extirpolated onto a regular grid, whose zero-padded FFT
+	gives the trigonometric sums on a fine regular frequency grid. The sums
+	at the note frequencies are then interpolated from that grid. The cost is
+	O(N log N) per frame whatever the number of frequencies. On integer
+	sample times, the extirpolation is exact and the result matches
+	LombScargleRegressor.fit up to the interpolation error.
+
+	Parameters
+	----------
+	window_size : int
+	    Number of input samples per window, when no sample times are given
+	sampling_rate : float
+	    Sampling rate of the input samples
+	oversampling : int
+	    Zero-padding factor of the FFT
+	order : int
+	    Number of nodes used by the extirpolation and the interpolation
+	grid_factor : int
+	    Number of grid points per sample period, for non-integer sample times
+	"""
+	def __init__(self, window_size, sampling_rate, oversampling = 8, order = 12, grid_factor = 2):
+		self.window_size = window_size
+		self.sampling_rate = sampling_rate
+		self.oversampling = oversampling
+		self.order = order
+		self.grid_factor = grid_factor
+		self.omegas = 2.0 * np.pi * Parameters.note_frequencies / sampling_rate
+
+	def trigonometricSums(self, Y, time):
+		""" Computes sum_j Y[:, j] * exp(i * k * omega * time[j]) for every row of Y,
+		every note frequency omega and k in {1, 2}. Y has one more row
+		than the input (a row of ones), used for the sums of the sinusoids. """
+		if np.all(time == np.round(time)):
+			grid_factor, order = 1, 1
+		else:
+			grid_factor, order = self.grid_factor, self.order
+		pad = order
+		u = (time - time.min()) * grid_factor
+		nodes, weights = lagrangeWeights(u, order)
+		nodes += pad
+		n_grid = int(np.ceil(u.max())) + 2 * pad + 1
+		grid = np.zeros((len(Y), n_grid), dtype = np.double)
+		if order == 1 and len(np.unique(nodes)) == len(nodes):
+			grid[:, nodes[:, 0]] = Y
+		else:
+			for m in range(order):
+				np.add.at(grid, (slice(None), nodes[:, m]), Y * weights[:, m])
+		origin = time.min() - pad / float(grid_factor)
+
+		""" The grid is real : the DFT at bin L - j is the conjugate of the
+		DFT at bin j, so only the first half of the spectrum is computed """
+		L = next_fast_len(self.oversampling * n_grid)
+		spectra = np.conj(np.fft.rfft(grid, n = L, axis = 1))
+		sums = list()
+		for k in [1, 2]:
+			positions = k * self.omegas / grid_factor * L / (2.0 * np.pi)
+			freq_nodes, freq_weights = lagrangeWeights(positions, self.order)
+			freq_nodes %= L
+			mirrored = freq_nodes > L // 2
+			values = spectra[:, np.where(mirrored, L - freq_nodes, freq_nodes)]
+			values = np.where(mirrored, np.conj(values), values)
+			values = (values * freq_weights).sum(axis = 2)
+			sums.append(values * np.exp(1j * k * self.omegas * origin))
+		return sums
+
+	def fitMatrix(self, frames, time = None):
+		""" Computes the periodograms of all the rows of frames at once.
+		If time is None, samples are assumed to be taken at 0, 1, 2, ... """
+		frames = np.atleast_2d(np.asarray(frames, dtype = np.double))
+		if time is None:
+			frames = frames[:, :self.window_size]
+			time = np.arange(frames.shape[1])
+		time = np.asarray(time, dtype = np.double)
+		n = float(len(time))
+		Y = np.concatenate((frames, np.ones((1, len(time)))), axis = 0)
+		sums, double_sums = self.trigonometricSums(Y, time)
+		C, S = sums[:-1].real, sums[:-1].imag
+		C1, S1 = sums[-1].real, sums[-1].imag
+		C2, S2 = double_sums[-1].real, double_sums[-1].imag
+
+		""" Same time delays as LombScargleRegressor.timeDelays """
+		phases = np.arctan(S1 / C1)
+		cos_tau, sin_tau = np.cos(phases), np.sin(phases)
+		cos_2tau, sin_2tau = np.cos(2.0 * phases), np.sin(2.0 * phases)
+		dens_a = 0.5 * n + 0.5 * (C2 * cos_2tau + S2 * sin_2tau)
+		dens_b = n - dens_a
+		num_a = (C * cos_tau + S * sin_tau) ** 2
+		num_b = (S * cos_tau - C * sin_tau) ** 2
+		return 0.5 * (num_a / dens_a + num_b / dens_b)
+
+	def fit(self, psi, time = None):
+		""" Computes the periodogram from input samples taken at the given times """
+		return self.fitMatrix(psi, time)[0]
+
+class TargetedDFTRegressor:
+	""" Evaluates the discrete Fourier transform of blackman-windowed frames
+	only at the frequency bins covered by the spectral windows of the notes,
+	and combines them into the same coefficients as the constant-Q transform
+	computed from a full FFT.
+
+	Parameters
+	----------
+	window_size : int
+	    Number of input samples per window
+	wins : list
+	    (first bin, last bin, weights) tuple of each note,
+	    as given by cognitive.getSpectralWindows
+	mode : str
+	    "gemm" to project the frames on precomputed sinusoids,
+	    "goertzel" to run the Goertzel recurrence on every bin
+
+	Attributes
+	----------
+	bins : np.ndarray[ndim = 1]
+	    Indexes of the DFT bins used by at least one note
+	weights : np.ndarray[ndim = 2]
+	    Weight of each bin (rows) in the coefficient of each note (columns)
+	"""
+	def __init__(self, window_size, wins, mode = "gemm"):
+		self.window_size = window_size
+		self.mode = mode
+		self.bins = np.unique(np.concatenate([np.arange(li, ri + 1) for li, ri, _ in wins]))
+		self.weights = np.zeros((len(self.bins), len(wins)), dtype = np.double)
+		for k, (li, ri, win) in enumerate(wins):
+			self.weights[np.searchsorted(self.bins, np.arange(li, ri + 1)), k] = win
+		self.blackman_win = np.blackman(window_size)
+		omegas = 2.0 * np.pi * self.bins / float(window_size)
+		if mode == "gemm":
+			tmp = np.outer(np.arange(window_size), omegas)
+			self.cos_waves = self.blackman_win[:, np.newaxis] * np.cos(tmp)
+			self.sin_waves = self.blackman_win[:, np.newaxis] * np.sin(tmp)
+		elif mode == "goertzel":
+			self.coefs = 2.0 * np.cos(omegas)
+		else:
+			raise ValueError("Unknown targeted DFT mode: %s" % str(mode))
+
+	def magnitudes(self, frames):
+		""" DFT magnitudes of the frames (rows) at every targeted bin """
+		frames = np.atleast_2d(frames)[:, :self.window_size]
+		if self.mode == "gemm":
+			real = np.dot(frames, self.cos_waves)
+			imag = np.dot(frames, self.sin_waves)
+			return np.sqrt(real ** 2 + imag ** 2)
+		power = goertzelPower(frames * self.blackman_win, self.coefs)
+		return np.sqrt(np.maximum(power, 0.0))
+
+	def fitMatrix(self, frames):
+		""" Computes the note coefficients of all the rows of frames at once """
+		return np.dot(self.magnitudes(frames), self.weights)
+
+def countPeriodogramFrames(signal):
+	T = len(signal) - Parameters.window_size
+	return len(range(0, max(0, T - 2 * Parameters.slide), 2 * Parameters.slide))
+
+def getPeriodogramFrames(signal, rows = None):
+	""" Returns the overlaid frames used by getPeriodograms as the rows of a matrix.
+	If rows (a slice or an array of indexes) is given, only these frames are built. """
+	window_size, slide = Parameters.window_size, Parameters.slide
+	starts = np.arange(countPeriodogramFrames(signal)) * 2 * slide
+	if rows is not None:
+		starts = starts[rows]
+	if len(starts) == 0:
+		return np.empty((0, window_size), dtype = np.double)
+	frames = np.lib.stride_tricks.sliding_window_view(signal, window_size)
+	return frames[starts] + frames[starts + slide]
+
 def getPeriodograms(signal):
 	window_size = Parameters.window_size
 	sampling_rate = Parameters.target_sampling_rate
@@ -124,20 +353,49 @@ def getPeriodograms(signal):
 	i, n_vectors = 0, 0
 	n_coefs = len(Parameters.note_frequencies)
 	n_samples = len(signal)
- 	T = n_samples - Parameters.window_size
- 	# blackman_win = np.blackman(Parameters.window_size)
+	T = n_samples - Parameters.window_size
+	# blackman_win = np.blackman(Parameters.window_size)
 	periodograms = np.empty(
-		((T + Parameters.window_size) / (2 * Parameters.slide) + 1, n_coefs), 
+		((T + Parameters.window_size) // (2 * Parameters.slide) + 1, n_coefs), 
 		dtype = np.double)
 	while i < T - Parameters.slide * 2:
-		frame = signal[i:i+Parameters.window_size]
-		i += Parameters.slide
-		frame += signal[i:i+Parameters.window_size]
-		i += Parameters.slide
+		frame = signal[i:i+Parameters.window_size] + signal[i+Parameters.slide:i+Parameters.slide+Parameters.window_size]
+		i += 2 * Parameters.slide
 		periodograms[n_vectors, :] = regressor.fit(frame)
 		n_vectors += 1
+	return periodograms[:n_vectors]
+
+
+def getMaskedPeriodograms(signal, mask, min_valid = 0.25):
+	""" Same as getPeriodograms, where the samples for which mask is False
+	(e.g. dropped or clipped samples) are left out of the periodograms.
+	Frames keeping less than min_valid of their samples get a periodogram
+	of zeros. The analysis of findKeyInSignal does not call it : it is meant
+	for callers that know which samples of a signal are unreliable. """
+	regressor = FastLombScargleRegressor(Parameters.window_size, Parameters.target_sampling_rate)
+	frames = getPeriodogramFrames(signal)
+	starts = np.arange(len(frames)) * 2 * Parameters.slide
+	periodograms = np.empty((len(frames), len(Parameters.note_frequencies)), dtype = np.double)
+	for n_vectors, i in enumerate(starts):
+		valid = mask[i:i+Parameters.window_size] & mask[i+Parameters.slide:i+Parameters.slide+Parameters.window_size]
+		if valid.sum() < max(2, min_valid * Parameters.window_size):
+			periodograms[n_vectors, :] = 0.0
+		else:
+			periodograms[n_vectors, :] = regressor.fit(frames[n_vectors, valid], np.where(valid)[0])
 	return periodograms
 
+def getVanicekSpectra(signal, mask = None):
+	""" Vaníček pseudo-spectra of the same frames as getPeriodograms.
+	If mask is given, only the frames for which it is True are analysed. """
+	regressor = VanicekRegressor(Parameters.window_size, Parameters.target_sampling_rate)
+	rows = np.arange(countPeriodogramFrames(signal))
+	if mask is not None:
+		rows = rows[mask]
+	""" Frames are built chunk by chunk : each one costs its two halves, their
+	sum and its projections on the sinusoids """
+	n_notes = len(Parameters.note_frequencies)
+	return processInChunks(lambda chunk: regressor.fitMatrix(getPeriodogramFrames(signal, rows[chunk])),
+		len(rows), n_notes, 8 * (3 * Parameters.window_size + 2 * n_notes), reserved = signal.nbytes)
 
 if __name__ == "__main__":
 	sampling_rate = 4410.0
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# sweep.py : Hyper-parameter sweeps sharing the common stages of the analysis
+# author : Antoine Passemiers
+
+import os, sys, ast, time, argparse, itertools, contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from cognitive import *
+from dataset import loadEntries
+from batch import getFeatureMatrix
+from markov import decodeKeyPath
+from memory import processInChunks
+from spectral import getPeriodogramFrames
+from neuhon import SPECTRAL_METHODS, DECISION_HISTOGRAM, DECISION_VITERBI
+
+""" Stages of the analysis, in order, with the fields each one depends on in
+addition to the fields of the stages before it. "frame_type" is derived from
+the method : the CQT and the targeted DFT analyse the same frames. The
+windows of these two methods do not overlap (they hop by window_size), so
+"slide" only affects the periodogram frames (see getStageFields). """
+SWEEP_STAGES = [
+    ("decode",   []),
+    ("decimate", ["target_sampling_rate"]),
+    ("frames",   ["window_size", "slide", "frame_type"]),
+    ("spectrum", ["method", "min_midi_note", "max_midi_note"]),
+    ("chroma",   ["chromatic_max_weight"]),
+    ("match",    ["profiles"]),
+    ("decision", ["decision"])]
+
+""" Fields that are not attributes of Parameters """
+SWEEP_OPTIONS = { "method" : "cqt", "profiles" : "custom", "decision" : DECISION_HISTOGRAM }
+
+SWEEP_DECISIONS = [DECISION_HISTOGRAM, DECISION_VITERBI]
+
+def getFrameType(method):
+    return "periodogram" if method in ("lomb-scargle", "vanicek") else "window"
+
+def getConfigurations(grid):
+    """ Cartesian product of a grid, given as a dict mapping field names to
+    lists of values. Fields missing from the grid keep their current value
+    (Parameters) or their default (SWEEP_OPTIONS). Every configuration holds
+    all the fields of SWEEP_STAGES. """
+    fields = [field for _, stage_fields in SWEEP_STAGES for field in stage_fields if field != "frame_type"]
+    for field in grid:
+        if field not in fields:
+            raise ValueError("Unknown sweep field: %s (expected one of %s)" % (field, ", ".join(fields)))
+    defaults = { field : SWEEP_OPTIONS[field] if field in SWEEP_OPTIONS else getattr(Parameters, field)
+        for field in fields }
+    names = sorted(grid.keys())
+    configs = list()
+    for values in itertools.product(*[list(grid[name]) for name in names]):
+        config = dict(defaults)
+        config.update(zip(names, values))
+        validateConfiguration(config)
+        config["frame_type"] = getFrameType(config["method"])
+        configs.append(config)
+    return configs
+
+def validateConfiguration(config):
+    if config["method"] not in SPECTRAL_METHODS:
+        raise ValueError("Unknown spectral method: %s" % str(config["method"]))
+    if config["profiles"] not in PROFILE_SETS:
+        raise ValueError("Unknown profile set: %s" % str(config["profiles"]))
+    if config["decision"] not in SWEEP_DECISIONS:
+        raise ValueError("Unsupported decision: %s" % str(config["decision"]))
+    n_notes = config["max_midi_note"] - config["min_midi_note"]
+    if n_notes <= 0 or n_notes % 12 != 0:
+        raise ValueError("The note range must span whole octaves: %d-%d" % (
+            config["min_midi_note"], config["max_midi_note"]))
+    if config["window_size"] <= 0 or config["slide"] <= 0:
+        raise ValueError("window_size and slide must be positive")
+
+class SweepNode:
+    """ Node of the stage graph of a sweep. A node stands for the output of a
+    stage for given values of the fields of this stage ; the configurations
+    sharing the same upstream values share the same path from the root, so
+    that each stage output is computed once for all of them.
+
+    Attributes
+    ----------
+    stage : str
+        Name of the stage, None for the root
+    values : dict
+        Values of the fields of the stage
+    children : dict
+        Nodes of the next stage, indexed by the values of its fields
+    configs : list
+        Indexes of the configurations whose decision is this node
+    """
+    def __init__(self, stage = None, values = None):
+        self.stage = stage
+        self.values = dict() if values is None else values
+        self.children = dict()
+        self.configs = list()
+
+    def countNodes(self):
+        return (self.stage is not None) + sum(child.countNodes() for child in self.children.values())
+
+def getStageFields(stage, fields, config):
+    """ Fields a stage actually depends on for a configuration """
+    if stage == "frames" and config["frame_type"] == "window":
+        return [field for field in fields if field != "slide"]
+    return fields
+
+def buildSweepTree(configs):
+    """ Merges the configurations into a tree of stage outputs """
+    root = SweepNode()
+    for i, config in enumerate(configs):
+        node = root
+        for stage, fields in SWEEP_STAGES:
+            fields = getStageFields(stage, fields, config)
+            key = tuple(config[field] for field in fields)
+            if key not in node.children:
+                node.children[key] = SweepNode(stage, { field : config[field] for field in fields })
+            node = node.children[key]
+        node.configs.append(i)
+    return root
+
+def setParameters(values):
+    """ Sets the fields of Parameters among values, and the fields derived
+    from the note range """
+    for name, value in values.items():
+        if name not in SWEEP_OPTIONS and name != "frame_type":
+            setattr(Parameters, name, value)
+    if "min_midi_note" in values or "target_sampling_rate" in values:
+        Parameters.n_octaves = (Parameters.max_midi_note - Parameters.min_midi_note) // 12
+        Parameters.note_frequencies = midiToHertz(
+            np.arange(Parameters.min_midi_note, Parameters.max_midi_note) - 1)
+        Parameters.note_periods = np.rint(
+            Parameters.target_sampling_rate / Parameters.note_frequencies).astype(int)
+
+@contextlib.contextmanager
+def preservedParameters():
+    """ Restores all the fields of Parameters on exit """
+    backup = { name : value for name, value in vars(Parameters).items() if not name.startswith("__") }
+    try:
+        yield
+    finally:
+        for name, value in backup.items():
+            setattr(Parameters, name, value)
+
+def computeStage(node, data, filename):
+    """ Output of the stage of a node, given the output of its parent """
+    if node.stage == "decode":
+        return getSignalFromFile(filename, mmap = True)
+    elif node.stage == "decimate":
+        return stereoToMono(np.asarray(downSampling(data, framerate = Parameters.target_sampling_rate)))
+    elif node.stage == "frames":
+        if node.values["frame_type"] == "periodogram":
+            return getPeriodogramFrames(data)
+        return getFrameMatrix(data)
+    elif node.stage == "spectrum":
+        method = SPECTRAL_METHODS[node.values["method"]]
+        n_coefs = 12 * Parameters.n_octaves
+        return processInChunks(lambda chunk: getFeatureMatrix(data[chunk], method),
+            len(data), n_coefs, 3 * 8 * Parameters.window_size, reserved = data.nbytes)
+    elif node.stage == "chroma":
+        return getChromaticMatrix(data)
+    elif node.stage == "match":
+        major, minor = PROFILE_SETS[node.values["profiles"]]
+        return getProfileScores(data, createProfileMatrix(major), createProfileMatrix(minor))
+    elif node.stage == "decision":
+        if node.values["decision"] == DECISION_VITERBI:
+            key = decodeKeyPath(data)[0]
+        else:
+            key = predictKeyFromHistogram(getKeyHistogram(getBestKeys(data)))
+        """ No frame, or only silent frames """
+        if key is None:
+            raise ValueError(NO_FRAME_MESSAGE)
+        return key
+    raise ValueError("Unknown stage: %s" % str(node.stage))
+
+def evaluateNode(node, data, filename, elapsed, keys, seconds, errors):
+    """ Computes the outputs of the subtree of a node (depth first, so that
+    only the outputs of the current path are held in memory). The time of a
+    configuration is the sum of the times of the stages on its path, i.e.
+    the time it would take on its own. """
+    for child in node.children.values():
+        start = time.time()
+        try:
+            setParameters(child.values)
+            output = computeStage(child, data, filename)
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, str(e))
+            for i in iterConfigs(child):
+                errors[i] = error
+            continue
+        stage_time = elapsed + time.time() - start
+        for i in child.configs:
+            keys[i], seconds[i] = output, stage_time
+        evaluateNode(child, output, filename, stage_time, keys, seconds, errors)
+
+def iterConfigs(node):
+    for i in node.configs:
+        yield i
+    for child in node.children.values():
+        for i in iterConfigs(child):
+            yield i
+
+""" Per-process state, set by initSweepWorker """
+_tree, _n_configs = None, 0
+
+def initSweepWorker(configs):
+    global _tree, _n_configs
+    _tree, _n_configs = buildSweepTree(configs), len(configs)
+
+def sweepFile(filename):
+    """ Predicted key, time and error (or None) of every configuration on a file """
+    keys, seconds, errors = [None] * _n_configs, [0.0] * _n_configs, [None] * _n_configs
+    with preservedParameters():
+        evaluateNode(_tree, None, filename, 0.0, keys, seconds, errors)
+    return keys, seconds, errors
+
+def runSweep(entries, grid, n_jobs = 1):
+    """ Evaluates every configuration of a grid on labelled files.
+
+    Parameters
+    ----------
+    entries : list
+        (entry id, filename, label) tuples, as returned by dataset.loadEntries
+    grid : dict
+        Lists of values of the swept fields (see getConfigurations)
+    n_jobs : int
+        Number of worker processes, each one sweeping whole files
+
+    Returns
+    -------
+    results : list
+        One dict per configuration, with its swept values, its MIREX score,
+        its time in seconds and its number of failed files. Files that fail
+        for some configurations only count as wrong predictions in their scores.
+    report : dict
+        Files, failed files, wall-clock time, time of the configurations
+        run one by one, and number of stage evaluations per file with and
+        without sharing
+    """
+    configs = getConfigurations(grid)
+    start = time.time()
+    filenames = [filename for _, filename, _ in entries]
+    if n_jobs == 1:
+        initSweepWorker(configs)
+        outputs = [sweepFile(filename) for filename in filenames]
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs, initializer = initSweepWorker,
+                initargs = (configs,)) as executor:
+            outputs = list(executor.map(sweepFile, filenames))
+    """ Files that no configuration can analyse (e.g. missing files) are left out """
+    failed = [all(error is not None for error in errors) for _, _, errors in outputs]
+    outputs = [output for output, is_failed in zip(outputs, failed) if not is_failed]
+    target_keys = [KEY_NAMES[label] for (_, _, label), is_failed in zip(entries, failed) if not is_failed]
+    results = list()
+    for i, config in enumerate(configs):
+        row = { name : config[name] for name in sorted(grid.keys()) }
+        predicted_keys = [keys[i] if errors[i] is None else None for keys, _, errors in outputs]
+        row["mirex"] = getMIREXScore(predicted_keys, target_keys)
+        row["seconds"] = sum(seconds[i] for _, seconds, _ in outputs)
+        row["errors"] = sum(errors[i] is not None for _, _, errors in outputs)
+        results.append(row)
+    report = {
+        "files" : len(entries),
+        "failed" : sum(failed),
+        "seconds" : time.time() - start,
+        "unshared_seconds" : sum(row["seconds"] for row in results),
+        "stages" : buildSweepTree(configs).countNodes(),
+        "unshared_stages" : len(configs) * len(SWEEP_STAGES) }
+    return results, report
+
+def showSweepResults(results, report, stream = sys.stdout):
+    """ Writes the results of runSweep as a table, best MIREX score first """
+    fields = [name for name in results[0] if name not in ("mirex", "seconds", "errors")] if results else list()
+    header = fields + ["mirex", "seconds", "errors"]
+    stream.write(("%14s" * len(header)) % tuple(header) + "\n")
+    for row in sorted(results, key = lambda row : -row["mirex"]):
+        stream.write("".join("%14s" % str(row[name]) for name in fields))
+        stream.write("%14.4f%14.2f%14d\n" % (row["mirex"], row["seconds"], row["errors"]))
+    stream.write("Files : %d (%d failed)\n" % (report["files"], report["failed"]))
+    stream.write("Stage evaluations per file : %d (%d without sharing)\n" % (
+        report["stages"], report["unshared_stages"]))
+    stream.write("Time : %.2f s (%.2f s without sharing)\n" % (report["seconds"], report["unshared_seconds"]))
+
+def parseGridArgument(argument):
+    """ "field=v1,v2,..." -> (field, [v1, v2, ...]), values being Python
+    literals or plain strings """
+    if "=" not in argument:
+        raise argparse.ArgumentTypeError("expected field=value1,value2,...: %s" % argument)
+    field, values = argument.split("=", 1)
+    def parseValue(value):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+    return field.strip(), [parseValue(value.strip()) for value in values.split(",")]
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "sweep",
+        description = "Evaluates a grid of hyper-parameters on the labelled dataset.")
+    parser.add_argument("grid", nargs = "+", type = parseGridArgument,
+        help = "swept field and its values, e.g. window_size=4096,8192 or method=cqt,vanicek "
+        "(fields : %s)" % ", ".join(field for _, fields in SWEEP_STAGES for field in fields
+            if field != "frame_type"))
+    parser.add_argument("--csv", default = CSV_PATH, help = "dataset CSV file")
+    parser.add_argument("--wav-path", default = WAV_PATH,
+        help = "folder of the wav files whose paths are relative in the CSV file")
+    parser.add_argument("-n", "--files", type = int, help = "number of files of the dataset")
+    parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1,
+        help = "number of worker processes")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer")
+    grid = dict(args.grid)
+    try:
+        getConfigurations(grid)
+    except ValueError as e:
+        parser.error(str(e))
+    results, report = runSweep(loadEntries(args.csv, args.files, wav_path = args.wav_path), grid, n_jobs = args.jobs)
+    showSweepResults(results, report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# test_batch.py : Batched key detection versus the per-signal analysis
+# author : Antoine Passemiers
+
+import unittest
+import numpy as np
+
+from batch import *
+
+class TestFindKeysInSignals(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        window_size = Parameters.window_size
+        t = np.arange(12 * window_size) / float(Parameters.target_sampling_rate)
+        chord = sum(np.sin(2.0 * np.pi * f * t) for f in [261.63, 329.63, 392.0])
+        """ Silent intro and silent gap in the middle of the chord """
+        chord[:3 * window_size] = 0.0
+        chord[6 * window_size:8 * window_size] = 0.0
+        self.signals = [
+            chord,
+            np.zeros(4 * window_size),
+            rng.randn(5 * window_size + 123),
+            rng.randn(window_size // 2),
+            chord[::-1].copy()]
+
+    def assertSameAsPerSignal(self, method, gate = False):
+        expected = [findKeyInSignal(signal, method = method, gate = gate) for signal in self.signals]
+        for batch_frames in [1, 3, 2048]:
+            keys, hists = findKeysInSignals(self.signals, method = method,
+                batch_frames = batch_frames, gate = gate)
+            self.assertEqual(hists.shape, (len(self.signals), 24))
+            for (key, _, hist, _), batch_key, batch_hist in zip(expected, keys, hists):
+                np.testing.assert_array_equal(batch_hist, hist)
+                self.assertEqual(batch_key, key)
+
+    def testCQT(self):
+        self.assertSameAsPerSignal(METHOD_CQT)
+
+    def testTargetedDFT(self):
+        self.assertSameAsPerSignal(METHOD_TARGETED_DFT)
+
+    def testLombScargle(self):
+        self.assertSameAsPerSignal(METHOD_LOMB_SCARGLE)
+
+    def testVanicek(self):
+        self.assertSameAsPerSignal(METHOD_VANICEK)
+
+    def testGate(self):
+        self.assertSameAsPerSignal(METHOD_CQT, gate = True)
+
+    def testSilentSignalHasNoKey(self):
+        keys, hists = findKeysInSignals([np.zeros(4 * Parameters.window_size)])
+        self.assertIsNone(keys[0])
+        self.assertEqual(hists.sum(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# test_kernels.py : The compiled loops of kernels.py versus their NumPy/SciPy fallbacks
+# author : Antoine Passemiers
+
+import unittest
+import numpy as np
+from scipy.signal import butter, lfilter as scipy_lfilter
+
+import kernels
+from cognitive import Parameters, StreamingLowPassFilter, lowPassFiltering, butter_lowpass_filter
+
+class TestKernels(unittest.TestCase):
+    """ Run with and without Numba (NEUHON_DISABLE_NUMBA=1) : without it,
+    use_kernel = True runs the same loops as plain Python """
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.frames = self.rng.randn(16, 1024)
+
+    def testLfilter(self):
+        b, a = butter(5, 0.25)
+        x = self.rng.randn(10000)
+        y, _ = kernels.lfilter(b, a, x)
+        np.testing.assert_allclose(y, scipy_lfilter(b, a, x), rtol = 1e-10, atol = 1e-12)
+        np.testing.assert_allclose(kernels.lfilter(b, a, x, use_kernel = True)[0], y, rtol = 1e-10, atol = 1e-12)
+
+    def testLfilterByBlocks(self):
+        b, a = butter(5, 0.25)
+        x = self.rng.randn(10000)
+        y, _ = kernels.lfilter(b, a, x)
+        for use_kernel in [False, True]:
+            blocks, zi = list(), None
+            for block in np.array_split(x, 7):
+                out, zi = kernels.lfilter(b, a, block, zi = zi, use_kernel = use_kernel)
+                blocks.append(out)
+            np.testing.assert_allclose(np.concatenate(blocks), y, rtol = 1e-10, atol = 1e-12)
+
+    def testStreamingLowPassFilter(self):
+        x = self.rng.randn(50000)
+        expected = butter_lowpass_filter(x, Parameters.lowpass_filter_cutoff_freq, Parameters.sampling_rate)
+        np.testing.assert_allclose(lowPassFiltering(x, block_size = 4096), expected, rtol = 1e-10, atol = 1e-12)
+        lowpass = StreamingLowPassFilter()
+        blocks = [lowpass.filter(block) for block in np.array_split(x, 13)]
+        np.testing.assert_allclose(np.concatenate(blocks), expected, rtol = 1e-10, atol = 1e-12)
+
+    def testGoertzelPower(self):
+        coefs = 2.0 * np.cos(2.0 * np.pi * self.rng.randint(0, 512, size = 40) / 1024.0)
+        compiled = kernels.goertzelPower(self.frames, coefs, use_kernel = True)
+        fallback = kernels.goertzelPower(self.frames, coefs, use_kernel = False)
+        np.testing.assert_allclose(compiled, fallback, rtol = 1e-8, atol = 1e-6)
+        bins = np.round(np.arccos(coefs / 2.0) * 1024.0 / (2.0 * np.pi)).astype(int)
+        expected = np.abs(np.fft.fft(self.frames, axis = 1)[:, bins]) ** 2
+        np.testing.assert_allclose(fallback, expected, rtol = 1e-6, atol = 1e-6)
+
+    def testZeroCrossingCounts(self):
+        np.testing.assert_array_equal(kernels.zeroCrossingCounts(self.frames, use_kernel = True),
+            kernels.zeroCrossingCounts(self.frames, use_kernel = False))
+
+    def testTransitionCounts(self):
+        observations = self.rng.randint(0, 24, size = 1000)
+        for shift in [0, 5, 23]:
+            np.testing.assert_array_equal(kernels.transitionCounts(observations, shift, use_kernel = True),
+                kernels.transitionCounts(observations, shift, use_kernel = False))
+
+if __name__ == "__main__":
+    unittest.main()
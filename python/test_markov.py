@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# test_markov.py : Decoding of key paths
+# author : Antoine Passemiers
+
+import unittest
+import numpy as np
+
+from utils import KEY_DICT
+from markov import decodeKeyPath, decodeKeyPathBatch
+
+class TestDecodeKeyPath(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.scores = 0.1 * rng.randn(40, 24)
+        self.scores[:25, KEY_DICT["Am"]] += 1.0
+        self.scores[25:, KEY_DICT["C"]] += 1.0
+
+    def testSegments(self):
+        key, path, segments = decodeKeyPath(self.scores)
+        self.assertEqual(key, "Am")
+        self.assertEqual(len(path), len(self.scores))
+        self.assertEqual(segments, [(0, 25, "Am"), (25, 40, "C")])
+
+    def testSilentFramesFollowTheirNeighbours(self):
+        self.scores[10:15] = np.nan
+        key, path, segments = decodeKeyPath(self.scores)
+        self.assertEqual(key, "Am")
+        self.assertEqual(segments, [(0, 25, "Am"), (25, 40, "C")])
+
+    def testNoScoredFrame(self):
+        for scores in [np.empty((0, 24)), np.full((5, 24), np.nan)]:
+            key, path, segments = decodeKeyPath(scores)
+            self.assertIsNone(key)
+            self.assertEqual(len(path), 0)
+            self.assertEqual(segments, list())
+
+    def testBatchMatchesSingleTracks(self):
+        tracks = [self.scores, np.empty((0, 24)), self.scores[5:30]]
+        for (key, path, segments), scores in zip(decodeKeyPathBatch(tracks), tracks):
+            expected_key, expected_path, expected_segments = decodeKeyPath(scores)
+            self.assertEqual(key, expected_key)
+            np.testing.assert_array_equal(path, expected_path)
+            self.assertEqual(segments, expected_segments)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# test_neuhon.py : Streaming of the tasks of the command-line tool
+# author : Antoine Passemiers
+
+import os, time, unittest
+
+from neuhon import *
+
+def analyseTask(task):
+    """ Kills its worker process on the task "crash", fails on the task
+    "raise", and returns a record otherwise """
+    if task == "crash":
+        os._exit(1)
+    elif task == "raise":
+        raise ValueError("Broken file")
+    time.sleep(0.1)
+    return [{ "file" : task, "key" : "C" }]
+
+def iterTasks(tasks, delay = 0.0):
+    for task in tasks:
+        time.sleep(delay)
+        yield task
+
+INITARGS = (METHOD_CQT, DECISION_HISTOGRAM, None)
+
+class TestIterPoolResults(unittest.TestCase):
+
+    def getRecords(self, tasks, n_jobs = 1, max_pending = None):
+        records = [record for records in iterPoolResults(analyseTask, tasks, n_jobs, INITARGS,
+            max_pending = max_pending) for record in records]
+        return { record["file"] : record for record in records }
+
+    def testRecords(self):
+        records = self.getRecords(iterTasks(["a", "raise", "b"], delay = 0.05))
+        self.assertEqual(sorted(records), ["a", "b", "raise"])
+        self.assertEqual(records["raise"]["error"], "ValueError: Broken file")
+        self.assertEqual(records["a"]["key"], "C")
+
+    def testTasksInFlightOfBrokenPool(self):
+        """ The tasks in flight when a worker dies are run again on a new
+        pool : only the task that killed the worker gets an error record """
+        tasks = ["a", "b", "crash", "c", "d", "e"]
+        records = self.getRecords(tasks, n_jobs = 2, max_pending = len(tasks))
+        self.assertEqual(sorted(records), sorted(tasks))
+        for task in tasks:
+            if task == "crash":
+                self.assertIn("BrokenProcessPool", records[task]["error"])
+            else:
+                self.assertNotIn("error", records[task])
+
+    def testInputError(self):
+        def iterBroken():
+            yield "a"
+            raise IOError("Manifest read error")
+        records = self.getRecords(iterBroken())
+        self.assertEqual(records[None]["error"], "OSError: Manifest read error")
+        self.assertNotIn("error", records["a"])
+
+if __name__ == "__main__":
+    unittest.main()
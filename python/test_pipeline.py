@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# test_pipeline.py : Overlapped decoding and analysis, with failing workers
+# author : Antoine Passemiers
+
+import os, time, tempfile, unittest
+import numpy as np
+from unittest import mock
+from scipy.io.wavfile import write as scipy_write
+
+import pipeline
+from pipeline import AnalysisPipeline
+
+_analyseSlot = pipeline.analyseSlot
+
+def crashOnFile(slot, length, filename):
+    """ Kills the worker process on the files named crash*.wav """
+    if os.path.basename(filename).startswith("crash"):
+        os._exit(1)
+    return _analyseSlot(slot, length, filename)
+
+def iterSlowly(filenames, delay = 2.0):
+    """ Yields the first file name, then the others after a delay, so that
+    they are submitted after the pool noticed the death of its worker """
+    yield filenames[0]
+    time.sleep(delay)
+    for filename in filenames[1:]:
+        yield filename
+
+class TestAnalysisPipeline(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        sampling_rate = int(pipeline.Parameters.sampling_rate)
+        cls.folder = tempfile.mkdtemp()
+        def write(name):
+            filename = os.path.join(cls.folder, name)
+            signal = (rng.randn(3 * sampling_rate, 2) * 3000).astype(np.int16)
+            scipy_write(filename, sampling_rate, signal)
+            return filename
+        cls.filenames = [write("%d.wav" % i) for i in range(3)]
+        cls.crash_filename = write("crash.wav")
+
+    def testRecords(self):
+        records = list(AnalysisPipeline(n_jobs = 1).run(self.filenames + ["missing.wav"]))
+        self.assertEqual(sorted(record["file"] for record in records), sorted(self.filenames + ["missing.wav"]))
+        for record in records:
+            self.assertEqual("error" in record, record["file"] == "missing.wav")
+
+    def testWorkerCrash(self):
+        """ The file whose worker dies gets an error record, and the next
+        files are analysed by a new pool """
+        filenames = [self.crash_filename] + self.filenames
+        with mock.patch("pipeline.analyseSlot", crashOnFile):
+            records = list(AnalysisPipeline(n_jobs = 1).run(iterSlowly(filenames)))
+        self.assertEqual(sorted(record["file"] for record in records), sorted(filenames))
+        for record in records:
+            if record["file"] == self.crash_filename:
+                self.assertIn("BrokenProcessPool", record["error"])
+            else:
+                self.assertNotIn("error", record)
+
+if __name__ == "__main__":
+    unittest.main()
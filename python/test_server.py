@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# test_server.py : Requests to the key detection service
+# author : Antoine Passemiers
+
+import io, os, asyncio, tempfile, unittest
+import numpy as np
+from scipy.io.wavfile import write as scipy_write
+
+from utils import midiToHertz
+from server import *
+
+""" Synthetic chords and the keys predicted for them. The default (custom)
+profiles were fit on full tracks through the key numbering of
+matchWithProfiles, and label a bare triad with the minor key of its root,
+whether the triad is major or minor : the root is what a triad determines,
+the mode is pinned so that a change of the profiles shows up here. """
+CHORDS = [
+    ([48, 52, 55], "Cm"), # C major
+    ([57, 60, 64], "Am"), # A minor
+    ([55, 59, 62], "Gm"), # G major
+    ([50, 53, 57], "Dm")] # D minor
+
+def makeSyntheticWav(midi_notes, duration = 10.0, noise = 0.05, seed = 0):
+    """ Returns the contents of a stereo wav file playing the given notes """
+    rng = np.random.RandomState(seed)
+    time = np.arange(int(duration * Parameters.sampling_rate)) / Parameters.sampling_rate
+    signal = sum(np.sin(2.0 * np.pi * midiToHertz(note) * time) for note in midi_notes)
+    signal = signal / max(1, len(midi_notes)) + noise * rng.randn(len(time))
+    signal = (np.clip(signal, -1.0, 1.0) * 20000).astype(np.int16)
+    buf = io.BytesIO()
+    scipy_write(buf, int(Parameters.sampling_rate), np.stack([signal, signal], axis = 1))
+    return buf.getvalue()
+
+class TestKeyServer(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.wavs = [makeSyntheticWav(CHORDS[i % len(CHORDS)][0], seed = i) for i in range(8)]
+        cls.silent_wav = makeSyntheticWav([], noise = 0.0)
+
+    async def asyncSetUp(self):
+        """ A long batch window, so that the concurrent requests share batches """
+        self.server = KeyServer(n_jobs = 1, batch_window = 0.5)
+        self.path = os.path.join(tempfile.mkdtemp(), "neuhon.sock")
+        self.task = asyncio.ensure_future(self.server.serve(path = self.path))
+        while not os.path.exists(self.path):
+            await asyncio.sleep(0.05)
+
+    async def asyncTearDown(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.server.close()
+
+    async def testConcurrentRequests(self):
+        """ Concurrent requests are grouped into batches and each one gets
+        the key of its own chord """
+        n_requests = len(self.wavs)
+        responses = await asyncio.gather(*[fetch("POST", "/key?method=cqt", wav, path = self.path)
+            for wav in self.wavs])
+        for i, (status, payload) in enumerate(responses):
+            self.assertEqual(status, 200)
+            self.assertEqual(payload["key"], CHORDS[i % len(CHORDS)][1])
+            self.assertGreater(payload["frames"], 0)
+            self.assertGreaterEqual(payload["seconds"], 0.0)
+        status, stats = await fetch("GET", "/stats", path = self.path)
+        self.assertEqual(status, 200)
+        self.assertEqual(stats["completed"], n_requests)
+        self.assertEqual(stats["errors"], 0)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["pending_signals"], 0)
+        self.assertEqual(stats["running_batches"], 0)
+        self.assertEqual(stats["batched_signals"], n_requests)
+        self.assertLess(stats["batches"], n_requests)
+        self.assertEqual(sorted(stats["latency_ms"]), ["p50", "p90", "p99"])
+
+    async def testMethods(self):
+        """ The G major chord is the one all the spectral methods agree on """
+        for method_name in SPECTRAL_METHODS:
+            status, payload = await fetch("POST", "/key?method=%s" % method_name,
+                self.wavs[2], path = self.path)
+            self.assertEqual(status, 200)
+            self.assertEqual(payload["key"], CHORDS[2][1])
+
+    async def testErrors(self):
+        status, payload = await fetch("POST", "/key", b"not a wav file", path = self.path)
+        self.assertEqual(status, 422)
+        self.assertIn("error", payload)
+        status, payload = await fetch("POST", "/key", self.silent_wav, path = self.path)
+        self.assertEqual(status, 422)
+        self.assertIn("silent", payload["error"])
+        status, payload = await fetch("POST", "/key?method=fourier", self.wavs[0], path = self.path)
+        self.assertEqual(status, 400)
+        status, payload = await fetch("GET", "/keys", path = self.path)
+        self.assertEqual(status, 404)
+        status, stats = await fetch("GET", "/stats", path = self.path)
+        self.assertEqual(stats["completed"], 0)
+        self.assertEqual(stats["errors"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
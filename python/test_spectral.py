@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# test_spectral.py : Tests of the spectral estimators
+# author : Antoine Passemiers
+
+import unittest
+import numpy as np
+
+from spectral import *
+
+class TestMaskedPeriodograms(unittest.TestCase):
+
+    def setUp(self):
+        self.signal = np.random.RandomState(0).randn(44100)
+
+    def testFullMaskMatchesPeriodograms(self):
+        expected = getPeriodograms(self.signal)
+        periodograms = getMaskedPeriodograms(self.signal, np.ones(len(self.signal), dtype = bool))
+        self.assertEqual(periodograms.shape, expected.shape)
+        self.assertLess(np.abs(periodograms - expected).max() / expected.max(), 1e-5)
+
+    def testDroppedStretchGivesZeroRows(self):
+        mask = np.ones(len(self.signal), dtype = bool)
+        mask[:20000] = False
+        periodograms = getMaskedPeriodograms(self.signal, mask)
+        self.assertTrue(np.all(np.isfinite(periodograms)))
+        empty = np.all(periodograms == 0.0, axis = 1)
+        self.assertTrue(empty[0])
+        self.assertFalse(empty[-1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -41,6 +41,23 @@ class Parameters:
     note_frequencies = midiToHertz(np.arange(min_midi_note, max_midi_note) - 1)
     note_periods = np.rint(target_sampling_rate / note_frequencies).astype(int)
 
+    """ Coarse-to-fine cascade (see cognitive.findKeyByCascade) """
+    cascade_frame_step = 4      # The coarse pass analyses one frame out of cascade_frame_step
+    cascade_margin_type = "hist" # Margin between the two best keys : "hist" or "scores"
+    cascade_min_hist_margin = 0.2   # Tracks whose "hist" margin (fraction of frames) is below this are fully analysed
+    cascade_min_score_margin = 0.03 # Same for the "scores" margin (in correlation units)
+    cascade_min_frames = 8      # Tracks with fewer coarse frames are always fully analysed
+
+    """ Frame gating (see cognitive.getFrameGate) """
+    gate_energy_ratio = 0.01    # Frames with less energy than this fraction of the median are silent
+    gate_flatness_deviations = 3.0 # Flatness above median + this many MADs (and high ZCR) is noise
+    gate_min_flatness = 0.25    # Frames less flat than this are never considered as noise
+    gate_min_kept = 0.5         # Noise gating is skipped if it leaves less than this fraction of frames
+    gate_decimation = 8         # Spectral flatness is estimated on frames decimated by this factor
+
+    """ Memory budget of a worker, in bytes (None : unlimited, see memory.getChunkSize) """
+    memory_budget = None
+
 def todo(func):
     def func_wrapper(*args):
         raise NotImplementedError("%s is not implemented yet" % func.__name__)
@@ -68,6 +85,23 @@ def showFinalResults(tp, out_by_a_fifth, out_by_a_fourth, parallels, relatives,
     print("Accuracy : %f" % (float(tp) / n_total))
     print("MIREX : %f" % (float(tp + 0.5 * (out_by_a_fourth + out_by_a_fifth) + 0.2 * parallels + 0.3 * relatives) / float(n_total)))
 
+def getMIREXScore(predicted_keys, target_keys):
+    """ Mean MIREX score of a list of predictions. Missing predictions
+    (None) are scored as wrong keys. """
+    score = 0.0
+    for predicted_key, target_key in zip(predicted_keys, target_keys):
+        if predicted_key is None:
+            continue
+        elif predicted_key == target_key:
+            score += 1.0
+        elif isOutByAFifth(predicted_key, target_key) or isOutByAFourth(predicted_key, target_key):
+            score += 0.5
+        elif isRelative(predicted_key, target_key):
+            score += 0.3
+        elif isParallel(predicted_key, target_key):
+            score += 0.2
+    return score / max(1, len(target_keys))
+
 def isDifferentToneType(predicted_key, target_key):
     if "m" in predicted_key and not "m" in target_key:
         return True